@@ -9,6 +9,7 @@ This version includes:
 """
 
 import os
+import re
 import sys
 import json
 import time
@@ -21,6 +22,12 @@ import PyPDF2
 import glob
 import hashlib
 import shutil
+import tempfile
+import math
+import zlib
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
 from datetime import datetime
 from rich.console import Console
@@ -30,6 +37,12 @@ from rich.panel import Panel
 from rich.table import Table
 from rich.progress import Progress, SpinnerColumn, TextColumn
 
+# NumPy is optional - it is only needed for the semantic (vector) retrieval backend
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Define the OCR A-Level CS curriculum structure based on the specification
 OCR_CS_CURRICULUM = {
     "computer_systems": {
@@ -171,13 +184,334 @@ LEARNING_MODES = {
     "test": "Test your knowledge with assessments based on past papers"
 }
 
+# Maximum size of a single knowledge base passage (in characters)
+PASSAGE_MAX_CHARS = 1500
+
+# Default number of passages and total characters returned by knowledge retrieval
+RETRIEVAL_PASSAGE_LIMIT = 6
+RETRIEVAL_MAX_CHARS = 6000
+
+# Knowledge retrieval backends: "fts" (keyword search), "vector" (semantic search)
+# or "topic" (all passages for the topic in document order)
+RETRIEVAL_BACKENDS = ["fts", "vector", "topic"]
+
+# Number of hashed features used for passage embeddings in the vector index
+VECTOR_DIMENSIONS = 4096
+
+# Maximum size of the per-topic reference block kept in the cached prompt prefix (in characters)
+TOPIC_REFERENCE_MAX_CHARS = 8000
+
+# Maximum size of the specification excerpt included for a topic (in characters)
+SPEC_SECTION_MAX_CHARS = 4000
+
+# Block size used when hashing files, so large PDFs are never read into memory at once
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Common words ignored when building full-text search queries
+SEARCH_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "does", "for",
+    "from", "how", "i", "if", "in", "is", "it", "me", "my", "of", "on", "or", "please",
+    "so", "that", "the", "this", "to", "was", "we", "what", "when", "where", "which",
+    "who", "why", "will", "with", "you", "your"
+}
+
+# Streaming requests wait in the pending request store between the POST that creates
+# them and the EventSource GET that runs them. Entries expire after this many seconds,
+# and the store never holds more than PENDING_REQUEST_MAX_ENTRIES
+PENDING_REQUEST_TTL = 120
+PENDING_REQUEST_MAX_ENTRIES = 1000
+
+# Cached answers to the fixed opening prompt of a topic and mode. Up to this many
+# different answers are kept per prompt, each for at most INITIAL_RESPONSE_CACHE_TTL
+# seconds, and the least recently used are evicted beyond INITIAL_RESPONSE_CACHE_MAX_ENTRIES
+INITIAL_RESPONSE_CACHE_VARIANTS = 3
+INITIAL_RESPONSE_CACHE_TTL = 7 * 24 * 60 * 60
+INITIAL_RESPONSE_CACHE_MAX_ENTRIES = 2000
+
+# User ID that progress recorded by the command-line tutor (which has no logins) is kept under
+LOCAL_USER_ID = 0
+
+# Conversation history sent to the model: at most this many recent messages, within
+# this many (estimated) tokens. Older turns are represented by the session summary
+HISTORY_WINDOW_MESSAGES = 20
+HISTORY_MAX_TOKENS = 6000
+
+# Maximum size of the stored summary of older conversation turns (in characters)
+SUMMARY_MAX_CHARS = 3000
+
+# Once the unsummarised part of a conversation passes this many (estimated) tokens,
+# its older turns are compacted into the stored summary
+COMPACTION_THRESHOLD_TOKENS = 8000
+
+# Number of recent messages kept word for word when a conversation is compacted
+COMPACTION_KEEP_MESSAGES = 6
+
+# Input token budget for one request. The system prompt and the student's question
+# always go in; every other part of the prompt gets at most its share of the budget,
+# and never more than is left once the parts before it have been added
+PROMPT_INPUT_BUDGET_TOKENS = 16000
+PROMPT_BUDGET_SHARES = {
+    "specification": 0.1,
+    "reference": 0.35,
+    "summary": 0.05,
+    "history": 0.4
+}
+
+# Words, and runs of symbols, each count as at least one token when estimating
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    """Roughly estimate the number of tokens in a piece of text.
+    
+    About 4 characters per token for prose, but never fewer than the number of words
+    and symbols, which matters for code and tables.
+    """
+    if not text:
+        return 0
+    return max(len(text) // 4, len(TOKEN_PATTERN.findall(text))) + 1
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to an estimated max_tokens, at a line break where possible."""
+    while text and estimate_tokens(text) > max_tokens:
+        cut = len(text) * max(max_tokens, 0) // estimate_tokens(text)
+        line_end = text.rfind("\n", 0, cut)
+        text = text[:line_end if line_end > cut // 2 else cut]
+    return text
+
+class PromptBudget:
+    """Shares a fixed input token budget between the parts of a prompt.
+    
+    Parts are added in priority order: required parts are charged in full, and the
+    others are cut down to whatever is left of their share.
+    """
+    
+    def __init__(self, total=PROMPT_INPUT_BUDGET_TOKENS, shares=None):
+        self.total = total
+        self.shares = PROMPT_BUDGET_SHARES if shares is None else shares
+        self.remaining = total
+        self.used = {}
+    
+    def allowance(self, part):
+        """Tokens still available for a part of the prompt."""
+        limit = self.remaining
+        if part in self.shares:
+            limit = min(limit, int(self.total * self.shares[part]) - self.used.get(part, 0))
+        return max(limit, 0)
+    
+    def charge(self, part, tokens):
+        """Record tokens spent on a part of the prompt."""
+        self.used[part] = self.used.get(part, 0) + tokens
+        self.remaining -= tokens
+    
+    def add_required(self, part, text):
+        """Charge a part that has to be sent whole, such as the system prompt or question."""
+        self.charge(part, estimate_tokens(text))
+        return text
+    
+    def fit_text(self, part, text):
+        """Cut a piece of text down to the part's allowance."""
+        text = truncate_to_tokens(text, self.allowance(part))
+        self.charge(part, estimate_tokens(text))
+        return text
+    
+    def fit_passages(self, part, passages):
+        """Keep the passages, best first, that fit in the part's allowance."""
+        kept = []
+        for passage in passages:
+            tokens = estimate_tokens(passage)
+            if tokens <= self.allowance(part):
+                kept.append(passage)
+                self.charge(part, tokens)
+        return kept
+    
+    def fit_history(self, messages, part="history"):
+        """Keep the most recent messages that fit in the part's allowance.
+        
+        The kept conversation always starts with a student message, as the API requires.
+        """
+        allowance = self.allowance(part)
+        kept = []
+        tokens = 0
+        for message in reversed(messages):
+            message_tokens = estimate_tokens(message["content"])
+            if tokens + message_tokens > allowance:
+                break
+            kept.append(message)
+            tokens += message_tokens
+        kept.reverse()
+        
+        while kept and kept[0]["role"] != "user":
+            tokens -= estimate_tokens(kept.pop(0)["content"])
+        self.charge(part, tokens)
+        return kept
+
+def with_summary(messages, summary):
+    """Put the summary of earlier turns in front of the first message of a conversation."""
+    if not summary or not messages:
+        return messages
+    messages = list(messages)
+    messages[0] = {
+        "role": messages[0]["role"],
+        "content": f"[SUMMARY OF EARLIER CONVERSATION]\n{summary}\n[END SUMMARY]\n\n{messages[0]['content']}"
+    }
+    return messages
+
+def split_for_compaction(messages, keep=COMPACTION_KEEP_MESSAGES):
+    """Split a conversation into the older turns to summarise and the recent turns to keep.
+    
+    The kept part always starts with a student message, as the API requires.
+    """
+    split = max(len(messages) - keep, 0)
+    while 0 < split < len(messages) and messages[split]["role"] != "user":
+        split -= 1
+    return messages[:split], messages[split:]
+
+def summarize_conversation(client, model, previous_summary, messages):
+    """Fold conversation turns into a running summary using the model."""
+    transcript = "\n\n".join(
+        f"{'Student' if message['role'] == 'user' else 'Tutor'}: {message['content']}"
+        for message in messages
+    )
+    previous = f"Summary of the conversation so far:\n{previous_summary}\n\n" if previous_summary else ""
+    
+    response = client.messages.create(
+        model=model,
+        max_tokens=SUMMARY_MAX_CHARS // 4,
+        temperature=0,
+        messages=[{
+            "role": "user",
+            "content": f"""{previous}Further conversation between an OCR A-Level Computer Science student and their tutor:
+
+{transcript}
+
+Write an updated summary of the whole conversation for the tutor to continue from. Keep it under {SUMMARY_MAX_CHARS // 6} words and use short bullet points covering the topics discussed, what the student understands, their misconceptions and any questions still open. Reply with the summary only."""
+        }]
+    )
+    return response.content[0].text.strip()
+
+# Words that only frame a question ("explain", "define"...) and are ignored, along with
+# the search stopwords, when comparing questions for the answer cache
+QUESTION_FILLER_WORDS = {
+    "describe", "define", "definition", "explain", "give", "know", "mean", "means",
+    "meant", "tell", "understand", "whats"
+}
+
+# Answer cache for near-duplicate questions: answers kept per topic and mode, and how
+# long (in seconds) they are kept
+ANSWER_CACHE_MAX_PER_TOPIC = 200
+ANSWER_CACHE_TTL = 30 * 24 * 60 * 60
+
+def question_shingles(question):
+    """Reduce a question to its set of word shingles: key words and adjacent pairs of them."""
+    # Drop the context and mode tags added by the web interface
+    question = re.sub(r"\[(CONTEXT|MODE):[^\]]*\]", " ", question)
+    
+    words = []
+    for word in re.findall(r"\w+", question.lower()):
+        # Treat simple plurals as the same word
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        if len(word) > 1 and word not in SEARCH_STOPWORDS and word not in QUESTION_FILLER_WORDS:
+            words.append(word)
+    
+    shingles = set(words)
+    shingles.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+    return shingles
+
+def shingle_similarity(first, second):
+    """Jaccard similarity of two shingle sets."""
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+class SQLiteConnectionPool:
+    """Process-wide pool of SQLite connections to a single database file.
+    
+    A thread checks out a connection the first time it needs one and keeps it
+    until release() is called, so a connection is never shared by two threads
+    at the same time. Released connections are kept open for reuse.
+    """
+    
+    def __init__(self, db_path, max_idle=8):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.idle = queue.LifoQueue()
+        self.local = threading.local()
+    
+    def create_connection(self):
+        """Open a new connection with WAL mode and tuned pragmas."""
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")       # Readers don't block the writer
+        conn.execute("PRAGMA synchronous = NORMAL")     # Safe with WAL and much faster than FULL
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -8000")       # 8 MB page cache
+        return conn
+    
+    def connection(self):
+        """Get the current thread's connection, checking one out of the pool if needed."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.create_connection()
+            self.local.conn = conn
+        return conn
+    
+    def release(self):
+        """Return the current thread's connection to the pool."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+        self.local.conn = None
+        
+        # Don't hand an unfinished transaction to the next thread
+        if conn.in_transaction:
+            conn.rollback()
+        
+        if self.idle.qsize() < self.max_idle:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+# One connection pool per database file, shared by every repository object in the process
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db_path):
+    """Get the shared connection pool for a database file."""
+    key = os.path.abspath(db_path)
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = SQLiteConnectionPool(db_path)
+        return connection_pools[key]
+
+def release_connections():
+    """Return all of the current thread's connections to their pools."""
+    with connection_pools_lock:
+        pools = list(connection_pools.values())
+    for pool in pools:
+        pool.release()
+
 class ResourceManager:
     """Manages reference materials and knowledge base for the OCR CS tutor."""
     
-    def __init__(self, resource_dir="resources", db_path="knowledge_base.db"):
+    def __init__(self, resource_dir="resources", db_path="knowledge_base.db", retrieval_backend="fts"):
         self.resource_dir = resource_dir
         self.db_path = db_path
-        self.conn = None
+        self.pool = get_connection_pool(db_path)
+        self.fts_enabled = False
+        self.retrieval_backend = retrieval_backend
+        
+        # Vector index files are stored next to the database
+        index_base = os.path.splitext(db_path)[0]
+        self.vector_matrix_path = f"{index_base}.vectors.npy"
+        self.vector_ids_path = f"{index_base}.vector_ids.npy"
+        self.vector_idf_path = f"{index_base}.idf.npy"
+        self.vector_matrix = None
+        self.vector_ids = None
+        self.vector_idf = None
         
         # Ensure resource directory exists
         os.makedirs(resource_dir, exist_ok=True)
@@ -185,10 +519,14 @@ class ResourceManager:
         # Initialize database
         self.init_database()
     
+    @property
+    def conn(self):
+        """The current thread's connection to the knowledge base, borrowed from the pool."""
+        return self.pool.connection()
+    
     def init_database(self):
         """Initialize the knowledge base database."""
         try:
-            self.conn = sqlite3.connect(self.db_path)
             cursor = self.conn.cursor()
             
             # Create files table
@@ -205,30 +543,162 @@ class ResourceManager:
             )
             ''')
             
-            # Create knowledge base table
+            # Add size and modification time columns used for the cheap duplicate check.
+            # Take the write lock before looking for them so two processes starting at
+            # once can't both add them
+            self.conn.commit()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("PRAGMA table_info(files)")
+            column_names = [col[1] for col in cursor.fetchall()]
+            if 'file_size' not in column_names:
+                cursor.execute("ALTER TABLE files ADD COLUMN file_size INTEGER")
+            if 'file_mtime' not in column_names:
+                cursor.execute("ALTER TABLE files ADD COLUMN file_mtime REAL")
+            self.conn.commit()
+            
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files (file_hash)")
+            # Unchanged files are recognised by path, size and modification time
+            cursor.execute("DROP INDEX IF EXISTS idx_files_size_mtime")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_path ON files (filepath)")
+            
+            # Create extracted text cache - zlib-compressed text and page start
+            # offsets, keyed by file hash so a PDF is only ever parsed once
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS extracted_text (
+                file_hash TEXT PRIMARY KEY,
+                content BLOB,
+                page_offsets TEXT,
+                date_extracted TIMESTAMP
+            )
+            ''')
+            
+            # Create knowledge passages table - each document is stored once,
+            # split into bounded passages
             cursor.execute('''
-            CREATE TABLE IF NOT EXISTS knowledge_base (
+            CREATE TABLE IF NOT EXISTS knowledge_passages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                topic_code TEXT,
-                content TEXT,
                 source_file_id INTEGER,
+                passage_index INTEGER,
+                content TEXT,
                 metadata TEXT,
                 FOREIGN KEY (source_file_id) REFERENCES files (id)
             )
             ''')
             
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_knowledge_passages_file ON knowledge_passages (source_file_id, passage_index)"
+            )
+            
+            # Create topic to passage mapping table
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS topic_passages (
+                topic_code TEXT,
+                passage_id INTEGER,
+                PRIMARY KEY (topic_code, passage_id),
+                FOREIGN KEY (passage_id) REFERENCES knowledge_passages (id)
+            ) WITHOUT ROWID
+            ''')
+            
+            # Create full-text index over passages for question-based retrieval
+            self.init_search_index()
+            
             self.conn.commit()
+            
+            # Convert any whole-document rows from older versions
+            self.migrate_legacy_knowledge_base()
         except sqlite3.Error as e:
             print(f"Database error: {e}")
-            if self.conn:
-                self.conn.close()
+            self.pool.release()
             sys.exit(1)
     
-    def get_file_hash(self, filepath):
+    def init_search_index(self):
+        """Create the FTS5 index over knowledge passages, if SQLite supports it."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'passages_fts'")
+        index_exists = cursor.fetchone() is not None
+        
+        try:
+            cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS passages_fts USING fts5(
+                content,
+                content='knowledge_passages',
+                content_rowid='id',
+                tokenize='porter unicode61'
+            )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable, falling back to topic lookup: {e}")
+            self.fts_enabled = False
+            return
+        
+        # Keep the index in step with the passages table
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS knowledge_passages_ai AFTER INSERT ON knowledge_passages BEGIN
+            INSERT INTO passages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS knowledge_passages_ad AFTER DELETE ON knowledge_passages BEGIN
+            INSERT INTO passages_fts (passages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        ''')
+        
+        # Index passages that were stored before the index existed
+        if not index_exists:
+            cursor.execute("INSERT INTO passages_fts (passages_fts) VALUES ('rebuild')")
+        
+        self.fts_enabled = True
+    
+    def migrate_legacy_knowledge_base(self):
+        """Convert the old whole-document knowledge_base table into passages."""
+        cursor = self.conn.cursor()
+        legacy_table_query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'knowledge_base'"
+        cursor.execute(legacy_table_query)
+        if not cursor.fetchone():
+            return
+        
+        # Take the write lock before checking again so two processes starting at
+        # once can't both convert the table
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(legacy_table_query)
+            if not cursor.fetchone():
+                self.conn.rollback()
+                return
+            
+            print("Migrating knowledge base to passages...")
+            
+            # The old table stored a full copy of each document once per matched topic
+            documents = {}
+            cursor.execute("SELECT source_file_id, topic_code, content FROM knowledge_base ORDER BY id")
+            for source_file_id, topic_code, content in cursor.fetchall():
+                if source_file_id not in documents:
+                    documents[source_file_id] = (content or "", [])
+                if topic_code not in documents[source_file_id][1]:
+                    documents[source_file_id][1].append(topic_code)
+            
+            for source_file_id, (content, topics) in documents.items():
+                self.store_passages(source_file_id, content, topics)
+            
+            cursor.execute("DROP TABLE knowledge_base")
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        
+        # Reclaim the space used by the duplicated documents
+        self.conn.execute("VACUUM")
+        print(f"Migrated {len(documents)} documents to the passage table")
+    
+    @staticmethod
+    def get_file_hash(filepath):
         """Generate hash for a file to check if it's already processed."""
+        file_hash = hashlib.md5()
         with open(filepath, 'rb') as f:
-            file_hash = hashlib.md5(f.read()).hexdigest()
-        return file_hash
+            # Hash in fixed-size blocks to keep memory use flat for large files
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
     
     def is_file_processed(self, file_hash):
         """Check if a file has already been processed based on its hash."""
@@ -236,10 +706,33 @@ class ResourceManager:
         cursor.execute("SELECT id FROM files WHERE file_hash = ?", (file_hash,))
         return cursor.fetchone() is not None
     
-    def add_file(self, filepath, category=None):
-        """Add a file to the resource database."""
+    def is_file_unchanged(self, filepath, file_size, file_mtime):
+        """Cheap duplicate check - the file at this path was imported and hasn't changed since.
+        
+        Any other file, including a fresh upload, is checked by its content hash instead.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT id FROM files WHERE filepath = ? AND file_size = ? AND file_mtime = ?",
+            (filepath, file_size, file_mtime)
+        )
+        return cursor.fetchone() is not None
+    
+    def add_file(self, filepath, category=None, move=False):
+        """Add a file to the resource database.
+        
+        With move=True the file is moved into the resource directory instead of
+        copied, which avoids a second copy of uploads that are already on disk.
+        """
         filename = os.path.basename(filepath)
         filetype = os.path.splitext(filename)[1].lower()[1:]  # Remove the dot
+        file_stat = os.stat(filepath)
+        
+        # Check the path, size and modification time first so unchanged files are never hashed
+        if self.is_file_unchanged(filepath, file_stat.st_size, file_stat.st_mtime):
+            print(f"File {filename} already processed (based on path, size and modification time).")
+            return None
+        
         file_hash = self.get_file_hash(filepath)
         
         # Check if file already exists in database
@@ -247,34 +740,103 @@ class ResourceManager:
             print(f"File {filename} already processed (based on hash).")
             return None
         
-        # Copy file to resource directory
+        # Move or copy file to resource directory
         destination = os.path.join(self.resource_dir, filename)
-        shutil.copy2(filepath, destination)
+        if os.path.exists(destination) and os.path.samefile(filepath, destination):
+            pass
+        elif move:
+            try:
+                os.replace(filepath, destination)
+            except OSError:
+                # Different filesystem - fall back to copy and delete
+                shutil.move(filepath, destination)
+        else:
+            shutil.copy2(filepath, destination)
         
         # Add file to database
         cursor = self.conn.cursor()
         cursor.execute(
-            "INSERT INTO files (filename, filepath, filetype, file_hash, date_added, category, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (filename, destination, filetype, file_hash, datetime.now(), category, "{}")
+            "INSERT INTO files (filename, filepath, filetype, file_hash, date_added, category, metadata, file_size, file_mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (filename, destination, filetype, file_hash, datetime.now(), category, "{}", file_stat.st_size, file_stat.st_mtime)
         )
         self.conn.commit()
         
         file_id = cursor.lastrowid
         return file_id
     
-    def extract_text_from_pdf(self, pdf_path):
-        """Extract text content from a PDF file."""
-        text = ""
+    @staticmethod
+    def extract_pdf_pages(pdf_path):
+        """Extract text content from a PDF file along with the offset where each page starts."""
+        pages = []
+        page_offsets = []
+        offset = 0
         try:
             with open(pdf_path, 'rb') as file:
                 reader = PyPDF2.PdfReader(file)
                 for page in reader.pages:
-                    text += page.extract_text() + "\n\n"
+                    page_text = page.extract_text() + "\n\n"
+                    page_offsets.append(offset)
+                    pages.append(page_text)
+                    offset += len(page_text)
         except Exception as e:
             print(f"Error extracting text from PDF: {e}")
-        return text
+        return "".join(pages), page_offsets
+    
+    @staticmethod
+    def extract_text_from_pdf(pdf_path):
+        """Extract text content from a PDF file."""
+        return ResourceManager.extract_pdf_pages(pdf_path)[0]
+    
+    def get_cached_text(self, file_hash):
+        """Look up previously extracted text and page offsets for a file hash."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT content, page_offsets FROM extracted_text WHERE file_hash = ?", (file_hash,))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        return zlib.decompress(result[0]).decode("utf-8"), json.loads(result[1])
+    
+    def cache_extracted_text(self, file_hash, text, page_offsets, commit=True):
+        """Store extracted text in the cache, compressed."""
+        # Don't cache failed extractions so they are retried next time
+        if not text:
+            return
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO extracted_text (file_hash, content, page_offsets, date_extracted) VALUES (?, ?, ?, ?)",
+            (file_hash, zlib.compress(text.encode("utf-8")), json.dumps(page_offsets), datetime.now())
+        )
+        if commit:
+            self.conn.commit()
+    
+    def get_extracted_pages(self, pdf_path, file_hash=None):
+        """Get a PDF's text and page offsets, parsing it only if it isn't cached yet."""
+        if file_hash is None:
+            # An imported file that hasn't changed since (same path, size and modification
+            # time) already has its hash recorded, so it doesn't need to be read
+            file_stat = os.stat(pdf_path)
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT file_hash FROM files WHERE filepath = ? AND file_size = ? AND file_mtime = ?",
+                (pdf_path, file_stat.st_size, file_stat.st_mtime)
+            )
+            result = cursor.fetchone()
+            file_hash = result[0] if result else self.get_file_hash(pdf_path)
+        
+        cached = self.get_cached_text(file_hash)
+        if cached:
+            return cached
+        
+        text, page_offsets = self.extract_pdf_pages(pdf_path)
+        self.cache_extracted_text(file_hash, text, page_offsets)
+        return text, page_offsets
+    
+    def get_extracted_text(self, pdf_path, file_hash=None):
+        """Get a PDF's text from the extracted text cache, parsing it only on a cache miss."""
+        return self.get_extracted_pages(pdf_path, file_hash)[0]
     
-    def read_text_file(self, file_path):
+    @staticmethod
+    def read_text_file(file_path):
         """Read content from a text file."""
         try:
             with open(file_path, 'r', encoding='utf-8') as file:
@@ -283,24 +845,32 @@ class ResourceManager:
             print(f"Error reading text file: {e}")
             return ""
     
+    @staticmethod
+    def extract_file_content(filepath, filetype):
+        """Extract content based on file type, or return None if the type is unsupported."""
+        if filetype == "pdf":
+            return ResourceManager.extract_text_from_pdf(filepath)
+        elif filetype in ["txt", "md", "py", "java", "c", "cpp", "cs"]:
+            return ResourceManager.read_text_file(filepath)
+        return None
+    
     def process_file_content(self, file_id):
         """Process a file and extract content for the knowledge base."""
         cursor = self.conn.cursor()
-        cursor.execute("SELECT filepath, filetype FROM files WHERE id = ?", (file_id,))
+        cursor.execute("SELECT filepath, filetype, file_hash FROM files WHERE id = ?", (file_id,))
         result = cursor.fetchone()
         
         if not result:
             return
         
-        filepath, filetype = result
+        filepath, filetype, file_hash = result
         
-        # Extract content based on file type
-        content = ""
+        # Extract content based on file type - PDFs go through the extracted text cache
         if filetype == "pdf":
-            content = self.extract_text_from_pdf(filepath)
-        elif filetype in ["txt", "md", "py", "java", "c", "cpp", "cs"]:
-            content = self.read_text_file(filepath)
+            content = self.get_extracted_text(filepath, file_hash)
         else:
+            content = self.extract_file_content(filepath, filetype)
+        if content is None:
             print(f"Unsupported file type: {filetype}")
             return
         
@@ -308,13 +878,61 @@ class ResourceManager:
         topics = self.categorize_content(content)
         
         # Add to knowledge base
-        for topic_code in topics:
+        self.store_passages(file_id, content, topics)
+        self.conn.commit()
+    
+    def store_passages(self, file_id, content, topics):
+        """Split content into passages and map each passage to the given topics."""
+        cursor = self.conn.cursor()
+        
+        for passage_index, passage in enumerate(self.split_into_passages(content)):
             cursor.execute(
-                "INSERT INTO knowledge_base (topic_code, content, source_file_id, metadata) VALUES (?, ?, ?, ?)",
-                (topic_code, content, file_id, "{}")
+                "INSERT INTO knowledge_passages (source_file_id, passage_index, content, metadata) VALUES (?, ?, ?, ?)",
+                (file_id, passage_index, passage, "{}")
+            )
+            passage_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT OR IGNORE INTO topic_passages (topic_code, passage_id) VALUES (?, ?)",
+                [(topic_code, passage_id) for topic_code in topics]
             )
+    
+    def split_into_passages(self, content, max_chars=PASSAGE_MAX_CHARS):
+        """Split text into passages of at most max_chars, breaking on paragraphs where possible."""
+        # Break the text into pieces that each fit in a passage
+        pieces = []
+        for paragraph in re.split(r"\n\s*\n", content):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if len(paragraph) <= max_chars:
+                pieces.append(paragraph)
+                continue
+            
+            # Paragraph is too long - fall back to line and then word boundaries
+            for line in paragraph.split("\n"):
+                line = line.strip()
+                while len(line) > max_chars:
+                    cut = line.rfind(" ", 0, max_chars)
+                    if cut <= 0:
+                        cut = max_chars
+                    pieces.append(line[:cut].strip())
+                    line = line[cut:].strip()
+                if line:
+                    pieces.append(line)
+        
+        # Merge consecutive pieces back together up to the passage size
+        passages = []
+        current = ""
+        for piece in pieces:
+            if current and len(current) + len(piece) + 2 > max_chars:
+                passages.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+        if current:
+            passages.append(current)
         
-        self.conn.commit()
+        return passages
     
     def categorize_content(self, content):
         """Attempt to categorize content by OCR CS topics."""
@@ -340,8 +958,12 @@ class ResourceManager:
         
         return topics
     
-    def bulk_import_from_directory(self, directory_path):
-        """Import all supported files from a directory."""
+    def bulk_import_from_directory(self, directory_path, workers=None):
+        """Import all supported files from a directory.
+        
+        Files are hashed and parsed in a process pool (workers=None uses one
+        process per CPU); pass workers=1 to import them one at a time.
+        """
         # Supported file extensions
         supported_extensions = [".pdf", ".txt", ".md", ".py", ".java", ".c", ".cpp", ".cs"]
         
@@ -352,6 +974,9 @@ class ResourceManager:
         
         print(f"Found {len(files)} supported files in {directory_path}")
         
+        if workers != 1 and len(files) > 1:
+            return self.parallel_import_files(sorted(files), workers)
+        
         # Process each file
         processed_count = 0
         with Progress(
@@ -371,65 +996,580 @@ class ResourceManager:
         
         return processed_count
     
-    def get_knowledge_for_topic(self, topic_code):
-        """Retrieve knowledge base content for a specific topic."""
+    def parallel_import_files(self, files, workers=None):
+        """Hash and extract files in worker processes, then store them in a single transaction."""
+        # Imported files that haven't changed since are skipped outright; the rest are
+        # checked by content hash
+        new_files = []
+        for file_path in files:
+            file_stat = os.stat(file_path)
+            if self.is_file_unchanged(file_path, file_stat.st_size, file_stat.st_mtime):
+                print(f"File {os.path.basename(file_path)} already processed (based on path, size and modification time).")
+            else:
+                new_files.append(file_path)
+        files = new_files
+        
+        # Workers skip parsing files whose hash is already in the database or
+        # whose text is already in the extracted text cache
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT file_hash FROM files UNION SELECT file_hash FROM extracted_text")
+        known_hashes = {row[0] for row in cursor.fetchall()}
+        
+        extracted = []
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            transient=True,
+        ) as progress:
+            task = progress.add_task("[green]Processing files...", total=len(files))
+            
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(extract_file_for_import, file_path, known_hashes): file_path for file_path in files}
+                for future in as_completed(futures):
+                    file_path = futures[future]
+                    progress.update(task, description=f"Processed {os.path.basename(file_path)}")
+                    try:
+                        extracted.append(future.result())
+                    except Exception as e:
+                        print(f"Error processing file {file_path}: {e}")
+                    progress.advance(task)
+            
+            # Keep the import order stable regardless of which worker finished first
+            extracted.sort(key=lambda result: result["filepath"])
+            
+            progress.update(task, description="Saving to knowledge base...")
+            processed_count = self.store_imported_files(extracted)
+        
+        return processed_count
+    
+    def store_imported_files(self, extracted, category=None):
+        """Write extracted files and their passages to the database in one transaction."""
         cursor = self.conn.cursor()
+        processed_count = 0
+        seen_hashes = set()
+        
+        try:
+            for result in extracted:
+                filename = os.path.basename(result["filepath"])
+                
+                # Skip files already in the database or repeated within this import
+                if result["file_hash"] in seen_hashes or self.is_file_processed(result["file_hash"]):
+                    print(f"File {filename} already processed (based on hash).")
+                    continue
+                
+                # Files skipped by the workers have their text in the cache
+                if result["content"] is None and result["filetype"] == "pdf":
+                    cached = self.get_cached_text(result["file_hash"])
+                    if cached:
+                        result["content"] = cached[0]
+                elif result["page_offsets"] is not None:
+                    self.cache_extracted_text(result["file_hash"], result["content"], result["page_offsets"], commit=False)
+                
+                if result["content"] is None:
+                    print(f"Unsupported file type: {result['filetype']}")
+                    continue
+                seen_hashes.add(result["file_hash"])
+                
+                # Copy file to resource directory
+                destination = os.path.join(self.resource_dir, filename)
+                if not os.path.exists(destination) or not os.path.samefile(result["filepath"], destination):
+                    shutil.copy2(result["filepath"], destination)
+                
+                cursor.execute(
+                    "INSERT INTO files (filename, filepath, filetype, file_hash, date_added, category, metadata, file_size, file_mtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (filename, destination, result["filetype"], result["file_hash"], datetime.now(), category, "{}", result["file_size"], result["file_mtime"])
+                )
+                file_id = cursor.lastrowid
+                
+                self.store_passages(file_id, result["content"], self.categorize_content(result["content"]))
+                processed_count += 1
+            
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
         
+        return processed_count
+    
+    def get_topic_codes(self, topic_code):
+        """Get the knowledge base topic codes relevant to a topic, most specific context first."""
         # Determine if this is a sub-topic and get its parent code
         is_subtopic = len(topic_code.split('.')) > 2
         parent_topic = '.'.join(topic_code.split('.')[:2]) if is_subtopic else topic_code
         
-        # For sub-topics, get the parent topic content first for better context
-        results = []
+        # For sub-topics, use the parent topic content first for better context,
+        # then direct matches for the specific topic, then general knowledge
         if is_subtopic:
+            return [parent_topic, topic_code, 'general']
+        return [topic_code, 'general']
+    
+    def get_knowledge_for_topic(self, topic_code, max_chars=None):
+        """Retrieve knowledge base passages for a specific topic, up to max_chars in total."""
+        cursor = self.conn.cursor()
+        
+        content = []
+        seen_ids = set()
+        total_chars = 0
+        for code in self.get_topic_codes(topic_code):
+            cursor.execute(
+                """
+                SELECT p.id, p.content FROM topic_passages t
+                JOIN knowledge_passages p ON p.id = t.passage_id
+                WHERE t.topic_code = ?
+                ORDER BY p.source_file_id, p.passage_index
+                """,
+                (code,)
+            )
+            
+            # Only read as many passages as fit in the budget
+            for passage_id, passage in cursor:
+                if passage_id in seen_ids:
+                    continue
+                if max_chars is not None and total_chars + len(passage) > max_chars:
+                    if not content:
+                        content.append(passage[:max_chars])
+                    return content
+                seen_ids.add(passage_id)
+                content.append(passage)
+                total_chars += len(passage)
+        
+        return content
+    
+    def get_topic_document(self, topic_code, max_chars=None):
+        """Get the passages of the resources written for a detailed topic, in document order,
+        up to max_chars in total.
+        
+        Resources are named after the topic they cover (e.g. "1.4.2. Data Structures.pdf"),
+        which is a surer guide than the topic codes mentioned in their text.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, filename FROM files WHERE filename LIKE ? ORDER BY id", (f"%{topic_code}%",))
+        
+        # "1.4" mustn't match "1.4.2", nor "1.4.2" match "1.4.21"
+        pattern = re.compile(rf"(?<![\d.]){re.escape(topic_code)}(?!\.?\d)")
+        file_ids = [file_id for file_id, filename in cursor.fetchall() if pattern.search(filename)]
+        
+        content = []
+        total_chars = 0
+        for file_id in file_ids:
             cursor.execute(
-                "SELECT content FROM knowledge_base WHERE topic_code = ?",
-                (parent_topic,)
+                "SELECT content FROM knowledge_passages WHERE source_file_id = ? ORDER BY passage_index",
+                (file_id,)
             )
-            results.extend(cursor.fetchall())
+            
+            # Only read as many passages as fit in the budget
+            for (passage,) in cursor:
+                if max_chars is not None and total_chars + len(passage) > max_chars:
+                    if not content:
+                        content.append(passage[:max_chars])
+                    return content
+                content.append(passage)
+                total_chars += len(passage)
+        
+        return content
+    
+    def build_search_query(self, text):
+        """Turn a student question into an FTS5 query matching any of its keywords."""
+        # Drop the context and mode tags added by the web interface
+        text = re.sub(r"\[(CONTEXT|MODE):[^\]]*\]", " ", text)
+        
+        terms = []
+        for word in re.findall(r"\w+", text.lower()):
+            if len(word) > 1 and word not in SEARCH_STOPWORDS and word not in terms:
+                terms.append(word)
+        
+        # Quote each term so FTS5 operators in the question are treated as text
+        return " OR ".join(f'"{term}"' for term in terms)
+    
+    def search_knowledge(self, question, topic_code=None, limit=RETRIEVAL_PASSAGE_LIMIT, max_chars=RETRIEVAL_MAX_CHARS):
+        """Retrieve the passages that best match a question, ranked by BM25, within a character budget."""
+        search_query = self.build_search_query(question)
+        
+        # Fall back to the topic's passages in document order if we can't search
+        if not self.fts_enabled or not search_query:
+            return self.get_knowledge_for_topic(topic_code, max_chars=max_chars) if topic_code else []
+        
+        cursor = self.conn.cursor()
+        sql = """
+            SELECT p.content FROM passages_fts
+            JOIN knowledge_passages p ON p.id = passages_fts.rowid
+            WHERE passages_fts MATCH ?
+        """
+        params = [search_query]
+        
+        # Restrict the search to passages for the topic
+        if topic_code:
+            topic_codes = self.get_topic_codes(topic_code)
+            sql += f" AND p.id IN (SELECT passage_id FROM topic_passages WHERE topic_code IN ({', '.join('?' * len(topic_codes))}))"
+            params.extend(topic_codes)
+        
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        except sqlite3.OperationalError as e:
+            print(f"Knowledge search error: {e}")
+            rows = []
+        
+        if not rows:
+            return self.get_knowledge_for_topic(topic_code, max_chars=max_chars) if topic_code else []
+        
+        # Keep the best passages that fit in the budget
+        content = []
+        total_chars = 0
+        for (passage,) in rows:
+            if max_chars is not None and total_chars + len(passage) > max_chars:
+                if not content:
+                    content.append(passage[:max_chars])
+                break
+            content.append(passage)
+            total_chars += len(passage)
+        
+        return content
+    
+    def get_text_features(self, text):
+        """Get hashed word unigram and bigram counts for a piece of text."""
+        words = [word for word in re.findall(r"\w+", text.lower()) if word not in SEARCH_STOPWORDS]
+        ngrams = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+        
+        # crc32 is stable across processes, unlike the built-in hash()
+        features = {}
+        for ngram in ngrams:
+            index = zlib.crc32(ngram.encode("utf-8")) % VECTOR_DIMENSIONS
+            features[index] = features.get(index, 0) + 1
+        return features
+    
+    def vectorize(self, texts, idf):
+        """Convert texts into L2-normalised TF-IDF vectors."""
+        matrix = np.zeros((len(texts), VECTOR_DIMENSIONS), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for index, count in self.get_text_features(text).items():
+                matrix[row, index] = 1.0 + math.log(count)
+        
+        matrix *= idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+    
+    @staticmethod
+    def save_array(path, array):
+        """Save a NumPy array by writing a temporary file and renaming it over path.
+        
+        Processes that have the old file memory-mapped keep reading it unchanged,
+        instead of seeing it rewritten under them.
+        """
+        directory, filename = os.path.split(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f"{filename}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    
+    def build_vector_index(self):
+        """Build the passage embedding matrix and save it next to the database."""
+        if np is None:
+            print("NumPy is not installed - the vector index is unavailable.")
+            return False
+        
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, content FROM knowledge_passages ORDER BY id")
+        rows = cursor.fetchall()
+        
+        passage_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        texts = [row[1] for row in rows]
+        
+        # Inverse document frequency of each hashed feature
+        document_frequency = np.zeros(VECTOR_DIMENSIONS, dtype=np.float32)
+        for text in texts:
+            document_frequency[list(self.get_text_features(text))] += 1
+        idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        
+        matrix = self.vectorize(texts, idf)
+        
+        # The ids go last, so a process that sees the new ids also sees the new matrix
+        self.save_array(self.vector_matrix_path, matrix)
+        self.save_array(self.vector_idf_path, idf)
+        self.save_array(self.vector_ids_path, passage_ids)
+        
+        self.vector_matrix = None
+        return True
+    
+    def load_vector_index(self):
+        """Memory-map the vector index, rebuilding it if the passages have changed."""
+        if np is None:
+            return False
+        
+        # The index is stale if passages were added or removed since it was built
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*), MAX(id) FROM knowledge_passages")
+        passage_count, max_id = cursor.fetchone()
+        
+        if self.vector_matrix is not None and len(self.vector_ids) == passage_count and \
+                (passage_count == 0 or self.vector_ids[-1] == max_id):
+            return True
+        
+        index_files = [self.vector_matrix_path, self.vector_ids_path, self.vector_idf_path]
+        if all(os.path.exists(path) for path in index_files):
+            vector_ids = np.load(self.vector_ids_path)
+            if len(vector_ids) != passage_count or (passage_count and vector_ids[-1] != max_id):
+                self.build_vector_index()
+        elif not self.build_vector_index():
+            return False
+        
+        self.vector_matrix = np.load(self.vector_matrix_path, mmap_mode="r")
+        self.vector_ids = np.load(self.vector_ids_path)
+        self.vector_idf = np.load(self.vector_idf_path)
+        return True
+    
+    def semantic_search_batch(self, questions, topic_code=None, limit=RETRIEVAL_PASSAGE_LIMIT):
+        """Find the most similar passage IDs for several questions with a single matrix product."""
+        if not questions or not self.load_vector_index() or len(self.vector_ids) == 0:
+            return [[] for _ in questions]
+        
+        query_matrix = self.vectorize(questions, self.vector_idf)
+        scores = self.vector_matrix @ query_matrix.T
+        
+        # Exclude passages that don't belong to the topic
+        if topic_code:
+            topic_codes = self.get_topic_codes(topic_code)
+            cursor = self.conn.cursor()
+            cursor.execute(
+                f"SELECT passage_id FROM topic_passages WHERE topic_code IN ({', '.join('?' * len(topic_codes))})",
+                topic_codes
+            )
+            allowed_ids = [row[0] for row in cursor.fetchall()]
+            scores[~np.isin(self.vector_ids, allowed_ids)] = -1.0
+        
+        results = []
+        top_count = min(limit, len(self.vector_ids))
+        for column in range(scores.shape[1]):
+            column_scores = scores[:, column]
+            top_rows = np.argpartition(-column_scores, top_count - 1)[:top_count]
+            top_rows = top_rows[np.argsort(-column_scores[top_rows])]
+            results.append([
+                (int(self.vector_ids[row]), float(column_scores[row]))
+                for row in top_rows if column_scores[row] > 0
+            ])
+        return results
+    
+    def semantic_search(self, question, topic_code=None, limit=RETRIEVAL_PASSAGE_LIMIT, max_chars=RETRIEVAL_MAX_CHARS):
+        """Retrieve the passages most similar to a question using the local vector index."""
+        matches = self.semantic_search_batch([question], topic_code, limit)[0]
+        if not matches:
+            return self.get_knowledge_for_topic(topic_code, max_chars=max_chars) if topic_code else []
+        
+        cursor = self.conn.cursor()
+        content = []
+        total_chars = 0
+        for passage_id, _ in matches:
+            cursor.execute("SELECT content FROM knowledge_passages WHERE id = ?", (passage_id,))
+            passage = cursor.fetchone()[0]
+            if max_chars is not None and total_chars + len(passage) > max_chars:
+                if not content:
+                    content.append(passage[:max_chars])
+                break
+            content.append(passage)
+            total_chars += len(passage)
+        
+        return content
+    
+    def retrieve_knowledge(self, question, topic_code=None, backend=None, limit=RETRIEVAL_PASSAGE_LIMIT, max_chars=RETRIEVAL_MAX_CHARS):
+        """Retrieve knowledge for a question using the configured retrieval backend."""
+        backend = backend or self.retrieval_backend
+        
+        if backend == "vector":
+            if np is not None:
+                return self.semantic_search(question, topic_code, limit, max_chars)
+            print("NumPy is not installed - using full-text search instead of the vector index.")
+            backend = "fts"
+        
+        if backend == "fts":
+            return self.search_knowledge(question, topic_code, limit, max_chars)
+        
+        return self.get_knowledge_for_topic(topic_code, max_chars=max_chars) if topic_code else []
+    
+    def compare_retrieval_backends(self, question, topic_code=None):
+        """Run a question against every retrieval backend and time each one."""
+        results = {}
+        for backend in RETRIEVAL_BACKENDS:
+            if backend == "vector" and np is None:
+                continue
+            start = time.perf_counter()
+            passages = self.retrieve_knowledge(question, topic_code, backend=backend)
+            results[backend] = {
+                "seconds": time.perf_counter() - start,
+                "passages": passages
+            }
+        return results
+    
+    def get_all_file_info(self):
+        """Get information about all processed files."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT id, filename, filetype, date_added, category FROM files ORDER BY date_added DESC"
+        )
+        return cursor.fetchall()
+    
+    def close(self):
+        """Return the database connection to the pool."""
+        self.pool.release()
+
+def extract_file_for_import(filepath, known_hashes=()):
+    """Hash a file and extract its text - runs in a worker process during bulk imports."""
+    filetype = os.path.splitext(filepath)[1].lower()[1:]  # Remove the dot
+    file_stat = os.stat(filepath)
+    file_hash = ResourceManager.get_file_hash(filepath)
+    
+    # Files that are already imported or cached don't need to be parsed again
+    content = None
+    page_offsets = None
+    if file_hash not in known_hashes:
+        if filetype == "pdf":
+            content, page_offsets = ResourceManager.extract_pdf_pages(filepath)
+        else:
+            content = ResourceManager.extract_file_content(filepath, filetype)
+    
+    return {
+        "filepath": filepath,
+        "filetype": filetype,
+        "file_hash": file_hash,
+        "file_size": file_stat.st_size,
+        "file_mtime": file_stat.st_mtime,
+        "content": content,
+        "page_offsets": page_offsets
+    }
+
+class SpecificationRegistry:
+    """Locates the OCR specification among the resources and caches its text split by topic."""
+    
+    def __init__(self, resource_manager):
+        self.resource_manager = resource_manager
+        self.spec_filename = None
+        self.spec_text = ""
+        self.topic_sections = {}
+        self.resource_dir_mtime = None
+        self.refresh()
+    
+    def refresh(self, force=False):
+        """Rebuild the registry if files have been added to or removed from the resource directory."""
+        try:
+            resource_dir_mtime = os.stat(self.resource_manager.resource_dir).st_mtime
+        except OSError:
+            resource_dir_mtime = None
+        
+        if not force and resource_dir_mtime == self.resource_dir_mtime:
+            return
+        self.resource_dir_mtime = resource_dir_mtime
+        
+        self.spec_filename = self.find_specification_file()
+        self.spec_text = ""
+        self.topic_sections = {}
+        
+        if self.spec_filename:
+            filepath = os.path.join(self.resource_manager.resource_dir, self.spec_filename)
+            if self.spec_filename.lower().endswith('.pdf'):
+                self.spec_text = self.resource_manager.get_extracted_text(filepath)
+            else:
+                self.spec_text = self.resource_manager.read_text_file(filepath)
+            self.topic_sections = self.split_by_topic(self.spec_text)
+    
+    def find_specification_file(self):
+        """Find the specification file in the resource directory."""
+        try:
+            filenames = sorted(os.listdir(self.resource_manager.resource_dir))
+        except OSError:
+            return None
         
-        # Then get direct matches for the specific topic
-        cursor.execute(
-            "SELECT content FROM knowledge_base WHERE topic_code = ?",
-            (topic_code,)
-        )
-        results.extend(cursor.fetchall())
+        # First check for the exact filename "Computer-Science-Spec"
+        for filename in filenames:
+            if filename.startswith("Computer-Science-Spec"):
+                return filename
         
-        # Also get general knowledge
-        cursor.execute(
-            "SELECT content FROM knowledge_base WHERE topic_code = 'general'"
-        )
-        results.extend(cursor.fetchall())
+        # If not found, look for files with "Spec" or "specification" in the name
+        for filename in filenames:
+            if "spec" in filename.lower() or "specification" in filename.lower():
+                return filename
         
-        # Extract content from results
-        content = [row[0] for row in results]
-        return content
+        return None
     
-    def get_all_file_info(self):
-        """Get information about all processed files."""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT id, filename, filetype, date_added, category FROM files ORDER BY date_added DESC"
-        )
-        return cursor.fetchall()
+    def split_by_topic(self, text):
+        """Split the specification text into sections keyed by topic code."""
+        known_codes = set(OCR_CS_DETAILED_TOPICS)
+        for topic_data in OCR_CS_DETAILED_TOPICS.values():
+            known_codes.update(subtopic.split()[0] for subtopic in topic_data["subtopics"])
+        
+        # Find every line that starts with a topic code
+        markers = [
+            (match.start(), match.group(1))
+            for match in re.finditer(r"^[ \t]*(\d\.\d(?:\.\d)?)\b", text, re.MULTILINE)
+            if match.group(1) in known_codes
+        ]
+        
+        # A code can appear several times (e.g. in the contents pages) - keep
+        # the longest section, which is the one with the actual content
+        sections = {}
+        for index, (start, code) in enumerate(markers):
+            end = markers[index + 1][0] if index + 1 < len(markers) else len(text)
+            section = text[start:end].strip()
+            if len(section) > len(sections.get(code, "")):
+                sections[code] = section
+        
+        return sections
     
-    def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
+    def get_section(self, topic_code, max_chars=SPEC_SECTION_MAX_CHARS):
+        """Get the part of the specification covering a topic, or None if it can't be found."""
+        self.refresh()
+        
+        # A main topic's section includes the sections of all of its subtopics
+        parts = [
+            section for code, section in sorted(self.topic_sections.items())
+            if code == topic_code or code.startswith(f"{topic_code}.")
+        ]
+        if not parts:
+            return None
+        
+        section = "\n\n".join(parts)
+        if len(section) > max_chars:
+            section = section[:max_chars] + "..."
+        return section
 
 class OCRCSDatabase:
     """Manages the student's learning progress and history."""
     
+    # Schema migrations, applied in order. Each one runs exactly once per database:
+    # PRAGMA user_version records how many have been applied
+    MIGRATIONS = [
+        "migrate_add_user_ids",
+        "migrate_add_indexes",
+        "migrate_add_session_summaries",
+        "migrate_add_api_usage",
+        "migrate_add_pending_requests",
+        "migrate_add_initial_response_cache",
+        "migrate_add_answer_cache",
+        "migrate_add_global_chat_sessions",
+        "migrate_add_exam_progress_summary",
+        "migrate_add_topic_progress_key",
+        "migrate_add_session_outlines",
+    ]
+    
     def __init__(self, db_path="ocr_cs_tutor.db"):
         self.db_path = db_path
-        self.conn = None
+        self.pool = get_connection_pool(db_path)
         self.init_database()
+    
+    @property
+    def conn(self):
+        """The current thread's connection to the database, borrowed from the pool."""
+        return self.pool.connection()
         
     def init_database(self):
         """Initialize the database with necessary tables."""
         try:
-            self.conn = sqlite3.connect(self.db_path)
             cursor = self.conn.cursor()
             
             # Create session history table
@@ -481,12 +1621,185 @@ class OCRCSDatabase:
             ''')
             
             self.conn.commit()
+            
+            self.run_migrations()
         except sqlite3.Error as e:
             print(f"Database error: {e}")
-            if self.conn:
-                self.conn.close()
+            self.pool.release()
             sys.exit(1)
     
+    def run_migrations(self):
+        """Apply any schema migrations this database hasn't had yet."""
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] >= len(self.MIGRATIONS):
+            return
+        
+        # Take the write lock before re-reading the version so two processes
+        # starting at once can't both apply the same migration
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("PRAGMA user_version")
+            version = cursor.fetchone()[0]
+            
+            for number, name in enumerate(self.MIGRATIONS[version:], start=version + 1):
+                print(f"Applying database migration {number}: {name}")
+                getattr(self, name)(cursor)
+                cursor.execute(f"PRAGMA user_version = {number}")
+            
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+    
+    @staticmethod
+    def add_column(cursor, table, column, definition):
+        """Add a column to a table unless it is already there."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
+    def migrate_add_user_ids(self, cursor):
+        """Migration 1: record which user owns sessions, progress and exam attempts."""
+        # Older copies of the web app added some of these columns themselves
+        for table in ("sessions", "topic_progress", "exam_practice"):
+            self.add_column(cursor, table, "user_id", "INTEGER")
+    
+    def migrate_add_indexes(self, cursor):
+        """Migration 2: index the columns every read query filters on."""
+        # Messages are read per session in insertion order
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_session ON conversation_history (session_id, id)")
+        # Progress and exam results are looked up per user and topic
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_topic_progress_user ON topic_progress (user_id, topic_code)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_exam_practice_user ON exam_practice (user_id, topic_code)")
+        # Session history is listed per user, newest first
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id, start_time)")
+    
+    def migrate_add_session_summaries(self, cursor):
+        """Migration 3: store a running summary of the turns that fall out of the history window."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            covered_until_id INTEGER,
+            updated_at TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES sessions (id)
+        )
+        ''')
+    
+    def migrate_add_api_usage(self, cursor):
+        """Migration 4: log the token usage of each model request, including prompt cache hits."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TIMESTAMP,
+            endpoint TEXT,
+            model TEXT,
+            input_tokens INTEGER,
+            output_tokens INTEGER,
+            cache_read_tokens INTEGER,
+            cache_creation_tokens INTEGER
+        )
+        ''')
+    
+    def migrate_add_pending_requests(self, cursor):
+        """Migration 5: hold streaming requests in the database so any worker process can run them."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_requests (
+            request_key TEXT PRIMARY KEY,
+            kind TEXT,
+            payload TEXT,
+            created_at REAL
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_requests_created ON pending_requests (created_at)")
+    
+    def migrate_add_initial_response_cache(self, cursor):
+        """Migration 6: cache answers to the opening prompts of topics."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS initial_response_cache (
+            cache_key TEXT,
+            variant INTEGER,
+            response TEXT,
+            created_at REAL,
+            last_used REAL,
+            PRIMARY KEY (cache_key, variant)
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_initial_response_cache_used ON initial_response_cache (last_used)")
+    
+    def migrate_add_answer_cache(self, cursor):
+        """Migration 7: cache answers to questions so near-duplicates can reuse them."""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic_code TEXT,
+            mode TEXT,
+            question TEXT,
+            shingles TEXT,
+            answer TEXT,
+            created_at REAL,
+            hits INTEGER DEFAULT 0
+        )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_answer_cache_topic ON answer_cache (topic_code, mode)")
+        
+        # Running totals of answer cache lookups
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answer_cache_stats (
+            outcome TEXT PRIMARY KEY,
+            count INTEGER
+        )
+        ''')
+    
+    def migrate_add_global_chat_sessions(self, cursor):
+        """Migration 8: keep each user's general chat in a session of its own, rather than in the cookie."""
+        self.add_column(cursor, "sessions", "session_type", "TEXT DEFAULT 'topic'")
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_global_chat ON sessions (user_id) WHERE session_type = 'global'"
+        )
+    
+    def migrate_add_exam_progress_summary(self, cursor):
+        """Migration 9: keep running exam practice averages per user, topic and question type."""
+        # Progress recorded without a user (by the command-line tutor) belongs to LOCAL_USER_ID
+        for table in ("topic_progress", "exam_practice"):
+            cursor.execute(f"UPDATE {table} SET user_id = ? WHERE user_id IS NULL", (LOCAL_USER_ID,))
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS exam_progress_summary (
+            user_id INTEGER NOT NULL,
+            topic_code TEXT NOT NULL,
+            question_type TEXT NOT NULL,
+            attempts INTEGER,
+            total_percent REAL,
+            last_attempted TIMESTAMP,
+            PRIMARY KEY (user_id, topic_code, question_type)
+        )
+        ''')
+        cursor.execute('''
+        INSERT OR REPLACE INTO exam_progress_summary
+        SELECT user_id, topic_code, question_type, COUNT(*), SUM(score*100.0/max_score), MAX(date_attempted)
+        FROM exam_practice
+        WHERE topic_code IS NOT NULL AND question_type IS NOT NULL AND score*100.0/max_score IS NOT NULL
+        GROUP BY user_id, topic_code, question_type
+        ''')
+    
+    def migrate_add_topic_progress_key(self, cursor):
+        """Migration 10: allow one progress row per user and topic, so ratings can be upserted."""
+        # Earlier versions could store the same topic twice; keep the latest rating
+        cursor.execute('''
+        DELETE FROM topic_progress WHERE id NOT IN (
+            SELECT MAX(id) FROM topic_progress GROUP BY user_id, topic_code
+        )
+        ''')
+        cursor.execute("DROP INDEX IF EXISTS idx_topic_progress_user")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_topic_progress_user_topic ON topic_progress (user_id, topic_code)")
+    
+    def migrate_add_session_outlines(self, cursor):
+        """Migration 11: keep the outline of earlier questions apart from the model-written summary."""
+        self.add_column(cursor, "session_summaries", "outline", "TEXT")
+        self.add_column(cursor, "session_summaries", "outlined_until_id", "INTEGER")
+    
     def start_session(self, topics=None):
         """Start a new learning session."""
         cursor = self.conn.cursor()
@@ -507,6 +1820,24 @@ class OCRCSDatabase:
         )
         self.conn.commit()
     
+    def get_global_chat_session(self, user_id):
+        """Get the id of a user's general chat session, creating it the first time."""
+        cursor = self.conn.cursor()
+        query = "SELECT id FROM sessions WHERE user_id = ? AND session_type = 'global'"
+        cursor.execute(query, (user_id,))
+        result = cursor.fetchone()
+        if result:
+            return result[0]
+        
+        # The unique index means concurrent first requests still share one session
+        cursor.execute(
+            "INSERT OR IGNORE INTO sessions (start_time, topics, user_id, session_type) VALUES (?, '', ?, 'global')",
+            (datetime.now(), user_id)
+        )
+        self.conn.commit()
+        cursor.execute(query, (user_id,))
+        return cursor.fetchone()[0]
+    
     def add_message(self, session_id, role, content):
         """Add a message to the conversation history."""
         cursor = self.conn.cursor()
@@ -516,36 +1847,71 @@ class OCRCSDatabase:
         )
         self.conn.commit()
     
-    def update_topic_progress(self, topic_code, topic_title, proficiency, notes=None):
-        """Update the student's progress on a specific topic."""
+    def count_user_messages(self, session_id):
+        """Count the messages the student has sent in a session."""
         cursor = self.conn.cursor()
-        # Check if the topic exists
         cursor.execute(
-            "SELECT id FROM topic_progress WHERE topic_code = ?",
-            (topic_code,)
+            "SELECT COUNT(*) FROM conversation_history WHERE session_id = ? AND role = 'user'",
+            (session_id,)
         )
-        result = cursor.fetchone()
+        return cursor.fetchone()[0]
+    
+    def clear_conversation(self, session_id):
+        """Delete a session's messages, along with its summary and outline of them."""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("DELETE FROM conversation_history WHERE session_id = ?", (session_id,))
+            cursor.execute("DELETE FROM session_summaries WHERE session_id = ?", (session_id,))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+    
+    def update_topic_progress(self, topic_code, topic_title, proficiency, notes=None, user_id=None):
+        """Update the student's progress on a specific topic."""
+        self.update_topics_progress([(topic_code, topic_title, proficiency, notes)], user_id=user_id)
+    
+    def update_topics_progress(self, ratings, user_id=None):
+        """Update the student's progress on several topics in one transaction.
         
-        if result:
-            # Update existing topic
-            cursor.execute(
-                "UPDATE topic_progress SET last_studied = ?, proficiency = ?, notes = ? WHERE topic_code = ?",
-                (datetime.now(), proficiency, notes, topic_code)
-            )
-        else:
-            # Insert new topic
-            cursor.execute(
-                "INSERT INTO topic_progress (topic_code, topic_title, last_studied, proficiency, notes) VALUES (?, ?, ?, ?, ?)",
-                (topic_code, topic_title, datetime.now(), proficiency, notes)
-            )
+        ratings is a list of (topic_code, topic_title, proficiency, notes) tuples. Each
+        is a single upsert on the (user_id, topic_code) key, so concurrent ratings of
+        the same topic can't create duplicate rows.
+        """
+        user_id = LOCAL_USER_ID if user_id is None else user_id
+        now = datetime.now()
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            '''INSERT INTO topic_progress (user_id, topic_code, topic_title, last_studied, proficiency, notes) VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(user_id, topic_code) DO UPDATE SET last_studied = excluded.last_studied,
+                   proficiency = excluded.proficiency, notes = excluded.notes''',
+            [(user_id, topic_code, topic_title, now, proficiency, notes) for topic_code, topic_title, proficiency, notes in ratings]
+        )
         self.conn.commit()
     
-    def record_exam_practice(self, topic_code, question_type, difficulty, score, max_score):
-        """Record results from exam practice attempts."""
+    def record_exam_practice(self, topic_code, question_type, difficulty, score, max_score, user_id=None):
+        """Record results from exam practice attempts.
+        
+        The running average for the topic and question type is updated in the same
+        transaction, so the progress page never has to scan past attempts.
+        """
+        user_id = LOCAL_USER_ID if user_id is None else user_id
+        now = datetime.now()
         cursor = self.conn.cursor()
         cursor.execute(
-            "INSERT INTO exam_practice (topic_code, question_type, difficulty, score, max_score, date_attempted) VALUES (?, ?, ?, ?, ?, ?)",
-            (topic_code, question_type, difficulty, score, max_score, datetime.now())
+            "INSERT INTO exam_practice (user_id, topic_code, question_type, difficulty, score, max_score, date_attempted) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, topic_code, question_type, difficulty, score, max_score, now)
+        )
+        # The percentage is worked out by SQLite, as the average used to be; an attempt
+        # without a valid maximum score doesn't count towards it
+        cursor.execute(
+            '''INSERT INTO exam_progress_summary (user_id, topic_code, question_type, attempts, total_percent, last_attempted)
+               SELECT ?, ?, ?, 1, percent, ? FROM (SELECT ? * 100.0 / ? AS percent) WHERE percent IS NOT NULL
+               ON CONFLICT(user_id, topic_code, question_type) DO UPDATE SET
+                   attempts = attempts + 1,
+                   total_percent = total_percent + excluded.total_percent,
+                   last_attempted = excluded.last_attempted''',
+            (user_id, topic_code, question_type, now, score, max_score)
         )
         self.conn.commit()
     
@@ -558,41 +1924,390 @@ class OCRCSDatabase:
         )
         return cursor.fetchall()
     
-    def get_topic_progress(self):
+    def get_topic_progress(self, user_id=None):
         """Get the student's progress on all topics."""
         cursor = self.conn.cursor()
         cursor.execute(
-            "SELECT topic_code, topic_title, last_studied, proficiency, notes FROM topic_progress ORDER BY topic_code"
+            "SELECT topic_code, topic_title, last_studied, proficiency, notes FROM topic_progress WHERE user_id = ? ORDER BY topic_code",
+            (LOCAL_USER_ID if user_id is None else user_id,)
         )
         return cursor.fetchall()
     
-    def get_exam_progress(self, topic_code=None):
-        """Get the student's progress on exam practice questions."""
+    def get_exam_progress(self, topic_code=None, user_id=None):
+        """Get the student's average exam practice score for each topic and question type."""
+        user_id = LOCAL_USER_ID if user_id is None else user_id
         cursor = self.conn.cursor()
         if topic_code:
             cursor.execute(
-                "SELECT topic_code, question_type, AVG(score*100.0/max_score) as avg_percent FROM exam_practice WHERE topic_code = ? GROUP BY topic_code, question_type",
-                (topic_code,)
+                "SELECT topic_code, question_type, total_percent / attempts AS avg_percent FROM exam_progress_summary WHERE user_id = ? AND topic_code = ? ORDER BY question_type",
+                (user_id, topic_code)
             )
         else:
             cursor.execute(
-                "SELECT topic_code, question_type, AVG(score*100.0/max_score) as avg_percent FROM exam_practice GROUP BY topic_code, question_type"
+                "SELECT topic_code, question_type, total_percent / attempts AS avg_percent FROM exam_progress_summary WHERE user_id = ? ORDER BY topic_code, question_type",
+                (user_id,)
             )
         return cursor.fetchall()
     
+    def record_api_usage(self, endpoint, model, input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens):
+        """Record the token usage of a model request."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "INSERT INTO api_usage (timestamp, endpoint, model, input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (datetime.now(), endpoint, model, input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens)
+        )
+        self.conn.commit()
+    
+    def get_api_usage_stats(self):
+        """Get prompt cache hits and misses and token totals for each endpoint."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            SELECT endpoint, COUNT(*),
+                   SUM(CASE WHEN cache_read_tokens > 0 THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN cache_read_tokens > 0 THEN 0 ELSE 1 END),
+                   SUM(input_tokens), SUM(output_tokens), SUM(cache_read_tokens), SUM(cache_creation_tokens)
+            FROM api_usage GROUP BY endpoint ORDER BY endpoint
+            """
+        )
+        return cursor.fetchall()
+    
+    def store_pending_request(self, kind, request_key, data):
+        """Store a streaming request until its EventSource connection picks it up."""
+        now = time.time()
+        cursor = self.conn.cursor()
+        
+        # Drop expired entries, then the oldest ones if the store is still full
+        cursor.execute("DELETE FROM pending_requests WHERE created_at <= ?", (now - PENDING_REQUEST_TTL,))
+        cursor.execute("SELECT COUNT(*) FROM pending_requests")
+        excess = cursor.fetchone()[0] - PENDING_REQUEST_MAX_ENTRIES + 1
+        if excess > 0:
+            cursor.execute(
+                "DELETE FROM pending_requests WHERE request_key IN (SELECT request_key FROM pending_requests ORDER BY created_at LIMIT ?)",
+                (excess,)
+            )
+        
+        cursor.execute(
+            "INSERT OR REPLACE INTO pending_requests (request_key, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+            (request_key, kind, json.dumps(data), now)
+        )
+        self.conn.commit()
+    
+    def take_pending_request(self, kinds, request_key):
+        """Remove and return a pending request of one of the given kinds, or None.
+        
+        Each request can only be taken once, even by concurrent workers.
+        """
+        cursor = self.conn.cursor()
+        placeholders = ", ".join("?" for _ in kinds)
+        cursor.execute(
+            f"DELETE FROM pending_requests WHERE request_key = ? AND kind IN ({placeholders}) AND created_at > ? RETURNING payload",
+            (request_key, *kinds, time.time() - PENDING_REQUEST_TTL)
+        )
+        result = cursor.fetchone()
+        self.conn.commit()
+        return json.loads(result[0]) if result else None
+    
+    def get_cached_initial_response(self, cache_key):
+        """Get one of the cached answers to an opening prompt, or None.
+        
+        Until INITIAL_RESPONSE_CACHE_VARIANTS answers have been cached this always
+        misses, so students don't all see the same answer.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "DELETE FROM initial_response_cache WHERE cache_key = ? AND created_at <= ?",
+            (cache_key, time.time() - INITIAL_RESPONSE_CACHE_TTL)
+        )
+        cursor.execute("SELECT COUNT(*) FROM initial_response_cache WHERE cache_key = ?", (cache_key,))
+        if cursor.fetchone()[0] < INITIAL_RESPONSE_CACHE_VARIANTS:
+            self.conn.commit()
+            return None
+        
+        cursor.execute(
+            "SELECT variant, response FROM initial_response_cache WHERE cache_key = ? ORDER BY RANDOM() LIMIT 1",
+            (cache_key,)
+        )
+        variant, response = cursor.fetchone()
+        cursor.execute(
+            "UPDATE initial_response_cache SET last_used = ? WHERE cache_key = ? AND variant = ?",
+            (time.time(), cache_key, variant)
+        )
+        self.conn.commit()
+        return response
+    
+    def cache_initial_response(self, cache_key, response):
+        """Add an answer to an opening prompt to the cache."""
+        now = time.time()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO initial_response_cache (cache_key, variant, response, created_at, last_used)
+            SELECT ?, COALESCE(MAX(variant), 0) + 1, ?, ?, ? FROM initial_response_cache WHERE cache_key = ?
+            """,
+            (cache_key, response, now, now, cache_key)
+        )
+        
+        # Evict the least recently used answers once the cache is full
+        cursor.execute("SELECT COUNT(*) FROM initial_response_cache")
+        excess = cursor.fetchone()[0] - INITIAL_RESPONSE_CACHE_MAX_ENTRIES
+        if excess > 0:
+            cursor.execute(
+                "DELETE FROM initial_response_cache WHERE rowid IN (SELECT rowid FROM initial_response_cache ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+        self.conn.commit()
+    
+    def find_cached_answer(self, topic_code, mode, question, threshold):
+        """Find a cached answer to a question similar enough to this one, or None.
+        
+        Every lookup is counted as a hit or a miss.
+        """
+        shingles = question_shingles(question)
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT id, shingles, answer FROM answer_cache WHERE topic_code = ? AND mode = ? AND created_at > ?",
+            (topic_code, mode, time.time() - ANSWER_CACHE_TTL)
+        )
+        
+        best_id, best_answer, best_similarity = None, None, threshold
+        for answer_id, cached_shingles, answer in cursor.fetchall():
+            similarity = shingle_similarity(shingles, set(json.loads(cached_shingles)))
+            if similarity >= best_similarity:
+                best_id, best_answer, best_similarity = answer_id, answer, similarity
+        
+        if best_id is not None:
+            cursor.execute("UPDATE answer_cache SET hits = hits + 1 WHERE id = ?", (best_id,))
+        cursor.execute(
+            "INSERT INTO answer_cache_stats (outcome, count) VALUES (?, 1) ON CONFLICT(outcome) DO UPDATE SET count = count + 1",
+            ("hit" if best_id is not None else "miss",)
+        )
+        self.conn.commit()
+        return best_answer
+    
+    def cache_answer(self, topic_code, mode, question, answer):
+        """Add an answer to the answer cache."""
+        shingles = question_shingles(question)
+        if not shingles:
+            return
+        
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "INSERT INTO answer_cache (topic_code, mode, question, shingles, answer, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (topic_code, mode, question, json.dumps(sorted(shingles)), answer, time.time())
+        )
+        
+        # Keep the most useful answers for the topic: expired ones go first, then the least used
+        cursor.execute(
+            """
+            DELETE FROM answer_cache WHERE id IN (
+                SELECT id FROM answer_cache WHERE topic_code = ? AND mode = ?
+                ORDER BY created_at > ? DESC, hits DESC, created_at DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (topic_code, mode, time.time() - ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_PER_TOPIC)
+        )
+        self.conn.commit()
+    
+    def get_answer_cache_stats(self):
+        """Get the number of answer cache hits and misses."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT outcome, count FROM answer_cache_stats")
+        counts = dict(cursor.fetchall())
+        return counts.get("hit", 0), counts.get("miss", 0)
+    
     def get_session_messages(self, session_id):
         """Get all messages from a specific session."""
         cursor = self.conn.cursor()
         cursor.execute(
-            "SELECT timestamp, role, content FROM conversation_history WHERE session_id = ? ORDER BY timestamp",
+            "SELECT timestamp, role, content FROM conversation_history WHERE session_id = ? ORDER BY id",
             (session_id,)
         )
         return cursor.fetchall()
     
+    def get_recent_messages(self, session_id, limit=HISTORY_WINDOW_MESSAGES, before_id=None):
+        """Get the latest messages from a session, oldest first, as (id, timestamp, role, content) rows.
+        
+        Pass the id of the oldest message already loaded as before_id to page further back.
+        """
+        cursor = self.conn.cursor()
+        if before_id is None:
+            cursor.execute(
+                "SELECT id, timestamp, role, content FROM conversation_history WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit)
+            )
+        else:
+            cursor.execute(
+                "SELECT id, timestamp, role, content FROM conversation_history WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before_id, limit)
+            )
+        rows = cursor.fetchall()
+        rows.reverse()
+        return rows
+    
+    def get_session_summary(self, session_id):
+        """Get the stored summary of a session's older turns and the id of the last message it covers."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT summary, covered_until_id FROM session_summaries WHERE session_id = ?",
+            (session_id,)
+        )
+        result = cursor.fetchone()
+        return result if result else (None, 0)
+    
+    def save_session_summary(self, session_id, summary, covered_until_id):
+        """Store the summary of a session's turns up to and including covered_until_id.
+        
+        The outline of earlier questions is cleared, as the summary now covers them.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(
+            '''INSERT INTO session_summaries (session_id, summary, covered_until_id, outline, outlined_until_id, updated_at)
+               VALUES (?, ?, ?, NULL, NULL, ?)
+               ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary,
+                   covered_until_id = excluded.covered_until_id, outline = NULL,
+                   outlined_until_id = NULL, updated_at = excluded.updated_at''',
+            (session_id, summary, covered_until_id, datetime.now())
+        )
+        self.conn.commit()
+    
+    def get_session_outline(self, session_id):
+        """Get the outline of the questions between a session's summary and its history window,
+        and the id of the last message it covers."""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT outline, outlined_until_id FROM session_summaries WHERE session_id = ?",
+            (session_id,)
+        )
+        result = cursor.fetchone()
+        return (result[0], result[1] or 0) if result else (None, 0)
+    
+    def update_session_outline(self, session_id, window_start_id):
+        """Extend the outline of earlier questions to every message before the history window.
+        
+        Only messages added since the outline was last updated are read, so the cost
+        doesn't grow with the length of the session. The model-written summary is left
+        to compact_session.
+        """
+        _, covered_until_id = self.get_session_summary(session_id)
+        outline, outlined_until_id = self.get_session_outline(session_id)
+        outlined_until_id = max(outlined_until_id, covered_until_id)
+        if outlined_until_id >= window_start_id - 1:
+            return outline
+        
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT id, role, content FROM conversation_history WHERE session_id = ? AND id > ? AND id < ? ORDER BY id",
+            (session_id, outlined_until_id, window_start_id)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return outline
+        
+        # Outline of the earlier questions; the tutor's answers followed from them
+        lines = outline.split("\n") if outline else []
+        for _, role, content in rows:
+            if role == "user":
+                question = " ".join(content.split())
+                if len(question) > 200:
+                    question = question[:200] + "..."
+                lines.append(f"- Student asked: {question}")
+        
+        # Keep the most recent part of the outline if it gets too long
+        while len(lines) > 1 and len("\n".join(lines)) > SUMMARY_MAX_CHARS:
+            lines.pop(0)
+        
+        outline = "\n".join(lines)
+        
+        # Not saved if the session was compacted meanwhile: the summary covers these turns now
+        cursor.execute(
+            '''INSERT INTO session_summaries (session_id, covered_until_id, outline, outlined_until_id, updated_at)
+               VALUES (?, 0, ?, ?, ?)
+               ON CONFLICT(session_id) DO UPDATE SET outline = excluded.outline,
+                   outlined_until_id = excluded.outlined_until_id, updated_at = excluded.updated_at
+               WHERE covered_until_id = ?''',
+            (session_id, outline, rows[-1][0], datetime.now(), covered_until_id)
+        )
+        self.conn.commit()
+        return outline
+    
+    def compact_session(self, session_id, summarize, threshold=COMPACTION_THRESHOLD_TOKENS, keep=COMPACTION_KEEP_MESSAGES):
+        """Fold a long session's older turns into its stored summary.
+        
+        summarize(previous_summary, messages) returns the new summary. Nothing happens
+        until the messages the summary doesn't cover yet exceed the token threshold.
+        Returns True if the session was compacted.
+        """
+        summary, covered_until_id = self.get_session_summary(session_id)
+        cursor = self.conn.cursor()
+        
+        # Cheap size check first: only the lengths are read
+        cursor.execute(
+            "SELECT COALESCE(SUM(LENGTH(content)), 0) FROM conversation_history WHERE session_id = ? AND id > ?",
+            (session_id, covered_until_id)
+        )
+        if cursor.fetchone()[0] // 4 <= threshold:
+            return False
+        
+        cursor.execute(
+            "SELECT id, role, content FROM conversation_history WHERE session_id = ? AND id > ? ORDER BY id",
+            (session_id, covered_until_id)
+        )
+        messages = [{"id": row[0], "role": row[1], "content": row[2]} for row in cursor.fetchall()]
+        older, _ = split_for_compaction(messages, keep)
+        if not older:
+            return False
+        
+        try:
+            summary = summarize(summary, older)
+        except Exception as e:
+            print(f"Error summarising session {session_id}: {e}")
+            return False
+        
+        self.save_session_summary(session_id, summary, older[-1]["id"])
+        return True
+    
+    def get_history_window(self, session_id, max_messages=HISTORY_WINDOW_MESSAGES, max_tokens=HISTORY_MAX_TOKENS):
+        """Get the conversation to send to the model: the most recent messages that fit
+        within the limits, and a summary of anything older.
+        
+        Returns (summary, messages). The summary is kept separate so the prompt budget
+        can fit it on its own; with_summary() puts it in front of the messages.
+        """
+        # Messages already folded into the summary or the outline aren't repeated
+        summary, covered_until_id = self.get_session_summary(session_id)
+        _, outlined_until_id = self.get_session_outline(session_id)
+        outlined_until_id = max(outlined_until_id, covered_until_id)
+        rows = [row for row in self.get_recent_messages(session_id, max_messages) if row[0] > outlined_until_id]
+        
+        # Keep as many of the newest messages as fit in the token budget
+        window = []
+        tokens = 0
+        for row in reversed(rows):
+            tokens += estimate_tokens(row[3])
+            if window and tokens > max_tokens:
+                break
+            window.append(row)
+        window.reverse()
+        
+        # The conversation sent to the model has to start with a student message
+        while window and window[0][2] != "user":
+            window.pop(0)
+        if not window:
+            return None, []
+        
+        messages = [{"role": role, "content": content} for _, _, role, content in window]
+        
+        # Anything older than the window is represented by the summary, followed by
+        # an outline of the questions asked since it was written
+        outline = self.update_session_outline(session_id, window[0][0])
+        summary = "\n\n".join(part for part in (summary, outline) if part) or None
+        return summary, messages
+    
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
+        """Return the database connection to the pool."""
+        self.pool.release()
 
 class OCRCSTutor:
     """OCR A-Level Computer Science AI Tutor using Anthropic's Claude API."""
@@ -602,11 +2317,13 @@ class OCRCSTutor:
         self.client = None
         self.db = OCRCSDatabase()
         self.resource_manager = resource_manager
+        self.spec_registry = SpecificationRegistry(resource_manager) if resource_manager else None
         self.session_id = None
         self.current_topic = None
         self.current_detailed_topic = None
         self.current_mode = None
         self.conversation_history = []
+        self.conversation_summary = None
         self.model = "claude-3-5-haiku-20241022"   #"claude-3-7-sonnet-20250219"
         
     def setup_api_client(self):
@@ -678,72 +2395,48 @@ class OCRCSTutor:
             # Debug print for prompt
             print(f"\n[DEBUG] Sending prompt to Claude: {prompt[:150]}..." if len(prompt) > 150 else f"\n[DEBUG] Sending prompt to Claude: {prompt}")
             
-            messages = []
-            
-            # Include conversation history if needed
-            if include_history and self.conversation_history:
-                messages = self.conversation_history.copy()
-                print(f"[DEBUG] Including conversation history with {len(messages)} previous messages")
+            # The prompt is assembled within the input token budget, most important parts first
+            budget = PromptBudget()
+            system_prompt = budget.add_required("system", self.create_system_prompt())
+            budget.add_required("question", prompt)
             
             # Augment prompt with knowledge base information if available
             augmented_prompt = prompt
             pdf_attached = False
             spec_added = False
             
-            # Check for specification file if this is the first prompt in a conversation
-            if not self.conversation_history and self.resource_manager:
-                spec_content = None
-                spec_filename = None
+            # Include the relevant part of the specification if this is the first prompt in a conversation
+            if not self.conversation_history and self.spec_registry and self.current_detailed_topic:
+                spec_content = self.spec_registry.get_section(self.current_detailed_topic.split()[0])
+                if spec_content:
+                    spec_content = budget.fit_text("specification", spec_content)
                 
-                # First check for the exact filename "Computer-Science-Spec"
-                for filename in os.listdir(self.resource_manager.resource_dir):
-                    if filename.startswith("Computer-Science-Spec"):
-                        spec_filename = filename
-                        break
-                
-                # If not found, look for files with "Spec" or "specification" in the name
-                if not spec_filename:
-                    for filename in os.listdir(self.resource_manager.resource_dir):
-                        if "spec" in filename.lower() or "specification" in filename.lower():
-                            spec_filename = filename
-                            break
-                
-                # If a specification file was found, read its content
-                if spec_filename:
-                    filepath = os.path.join(self.resource_manager.resource_dir, spec_filename)
-                    if spec_filename.lower().endswith('.pdf'):
-                        spec_content = self.resource_manager.extract_text_from_pdf(filepath)
-                    else:
-                        spec_content = self.resource_manager.read_text_file(filepath)
+                if spec_content:
+                    print(f"[DEBUG] Including specification section from: {self.spec_registry.spec_filename}")
+                    spec_added = True
                     
-                    if spec_content:
-                        print(f"[DEBUG] Including specification file: {spec_filename}")
-                        spec_added = True
-                        
-                        # Add specification to prompt
-                        augmented_prompt = f"""
-                        [SPECIFICATION INFORMATION]
-                        The following information is from the OCR A-Level Computer Science specification:
-                        
-                        {spec_content}
-                        
-                        [END SPECIFICATION INFORMATION]
-                        
-                        STUDENT QUESTION:
-                        {prompt}
-                        """
+                    # Add specification to prompt
+                    augmented_prompt = f"""
+                    [SPECIFICATION INFORMATION]
+                    The following information is from the OCR A-Level Computer Science specification:
+                    
+                    {spec_content}
+                    
+                    [END SPECIFICATION INFORMATION]
+                    
+                    STUDENT QUESTION:
+                    {prompt}
+                    """
             
             # Add topic-specific knowledge if available
             if include_knowledge and self.resource_manager and self.current_detailed_topic:
                 topic_code = self.current_detailed_topic.split()[0]
-                knowledge = self.resource_manager.get_knowledge_for_topic(topic_code)
+                # Only include the passages most relevant to the question
+                knowledge = budget.fit_passages("reference", self.resource_manager.retrieve_knowledge(prompt, topic_code))
                 
                 if knowledge:
                     pdf_attached = True
-                    # Summarize knowledge to avoid exceeding context limits
                     knowledge_text = "\n\n".join(knowledge)
-                    if len(knowledge_text) > 10000:  # Limit knowledge text size
-                        knowledge_text = knowledge_text[:10000] + "..."
                     
                     print(f"[DEBUG] Attaching PDF/reference data for topic: {self.current_detailed_topic}")
                     
@@ -773,6 +2466,17 @@ class OCRCSTutor:
                         
                         Please use the reference information where appropriate to give an accurate, specification-aligned response.
                         """
+            
+            messages = []
+            
+            # Include as much of the conversation history as fits, if needed
+            if include_history and self.conversation_history:
+                # Earlier turns that were compacted are represented by their summary
+                summary = budget.fit_text("summary", self.conversation_summary) if self.conversation_summary else None
+                
+                messages = budget.fit_history(self.conversation_history)
+                print(f"[DEBUG] Including conversation history with {len(messages)} of {len(self.conversation_history)} previous messages")
+                messages = with_summary(messages, summary)
                     
             # Add the current prompt
             messages.append({"role": "user", "content": augmented_prompt})
@@ -788,7 +2492,7 @@ class OCRCSTutor:
                 model=self.model,
                 max_tokens=4096,
                 temperature=0.7,
-                system=self.create_system_prompt(),
+                system=system_prompt,
                 messages=messages
             )
             
@@ -806,6 +2510,8 @@ class OCRCSTutor:
                 self.db.add_message(self.session_id, "user", prompt)
                 self.db.add_message(self.session_id, "assistant", response_text)
             
+            self.compact_history()
+            
             return response_text
             
         except anthropic.RateLimitError:
@@ -814,6 +2520,25 @@ class OCRCSTutor:
             self.console.print(f"[bold red]Error:[/bold red] {str(e)}")
             return "Sorry, I couldn't generate a response at this time."
     
+    def compact_history(self):
+        """Fold older turns into the conversation summary once the history gets too long."""
+        tokens = sum(estimate_tokens(message["content"]) for message in self.conversation_history)
+        if tokens <= COMPACTION_THRESHOLD_TOKENS:
+            return
+        
+        older, recent = split_for_compaction(self.conversation_history)
+        if not older:
+            return
+        
+        try:
+            self.conversation_summary = summarize_conversation(self.client, self.model, self.conversation_summary, older)
+        except Exception as e:
+            print(f"[DEBUG] Could not summarise conversation: {e}")
+            return
+        
+        print(f"[DEBUG] Compacted {len(older)} earlier messages into the conversation summary")
+        self.conversation_history = recent
+    
     def display_curriculum(self):
         """Display the OCR A-Level CS curriculum structure."""
         table = Table(title="OCR A-Level Computer Science Curriculum (H446)")
@@ -961,6 +2686,7 @@ class OCRCSTutor:
         
         # Reset conversation history
         self.conversation_history = []
+        self.conversation_summary = None
         
         # Create initial prompt based on topic and mode
         initial_prompt = self.create_initial_prompt(component, main_topic, detailed_topic, mode)
@@ -1227,6 +2953,7 @@ class OCRCSTutor:
                     continue
                 elif user_input.lower() == 'clear':
                     self.conversation_history = []
+                    self.conversation_summary = None
                     self.console.print("[green]Conversation history cleared.[/green]")
                     continue
                 elif user_input.lower() == 'summary':
@@ -1329,6 +3056,8 @@ class OCRCSAdmin:
                     tutor = OCRCSTutor(resource_manager=self.resource_manager)
                     tutor.setup_api_client()
                     tutor.interactive_mode()
+                elif choice == '6':
+                    self.compare_retrieval()
                 elif choice == '0':
                     self.console.print("[green]Exiting admin interface.[/green]")
                     break
@@ -1352,6 +3081,7 @@ class OCRCSAdmin:
         self.console.print("3. View imported resources")
         self.console.print("4. View knowledge base")
         self.console.print("5. Start user tutor interface")
+        self.console.print("6. Compare knowledge retrieval backends")
         self.console.print("0. Exit")
     
     def import_directory(self):
@@ -1456,6 +3186,35 @@ class OCRCSAdmin:
         except ValueError:
             self.console.print("[red]Please enter a number.[/red]")
 
+    def compare_retrieval(self):
+        """Compare the latency and results of each knowledge retrieval backend."""
+        question = input("\nEnter a sample student question: ").strip()
+        if not question:
+            return
+        topic_code = input("Enter topic code (optional, e.g. 1.1.1): ").strip() or None
+        
+        results = self.resource_manager.compare_retrieval_backends(question, topic_code)
+        
+        table = Table(title="Knowledge Retrieval Comparison")
+        table.add_column("Backend", style="cyan")
+        table.add_column("Time (ms)", style="yellow")
+        table.add_column("Passages", style="green")
+        table.add_column("Characters", style="magenta")
+        table.add_column("Top Passage", style="blue")
+        
+        for backend, result in results.items():
+            passages = result["passages"]
+            top_passage = passages[0][:80].replace("\n", " ") if passages else ""
+            table.add_row(
+                backend,
+                f"{result['seconds'] * 1000:.2f}",
+                str(len(passages)),
+                str(sum(len(passage) for passage in passages)),
+                top_passage
+            )
+        
+        self.console.print(table)
+
 def main():
     """Main function to run either the admin or user interface."""
     console = Console()
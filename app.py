@@ -4,7 +4,7 @@ OCR A-Level Computer Science AI Tutor Web Interface
 
 """
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory, Response
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, send_from_directory, Response, stream_with_context
 import os
 import json
 import anthropic
@@ -12,9 +12,13 @@ import sqlite3
 import hashlib
 import shutil
 import time
+import random
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Model Option:
@@ -23,7 +27,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 AI_MODEL = "claude-3-5-haiku-20241022"
 
 # Import existing classes from the command-line application
-from Claude_CS_Test import ResourceManager, OCRCSDatabase, OCR_CS_CURRICULUM, OCR_CS_DETAILED_TOPICS, LEARNING_MODES
+from Claude_CS_Test import ResourceManager, OCRCSDatabase, PromptBudget, get_connection_pool, release_connections, summarize_conversation, with_summary, TOPIC_REFERENCE_MAX_CHARS, OCR_CS_CURRICULUM, OCR_CS_DETAILED_TOPICS, LEARNING_MODES
 
 # Create a more accessible topic lookup dictionary
 OCR_CS_TOPIC_LOOKUP = {}
@@ -65,67 +69,346 @@ for main_topic_code, main_topic_data in OCR_CS_DETAILED_TOPICS.items():
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "ocr_cs_tutor_secret_key")  # Change in production
 
+# User accounts database
+USER_DB_PATH = 'user_database.db'
+
 # Initialize resource manager and database
-# We'll create these per request to avoid thread safety issues with SQLite
+# These are created once per process and shared by all request threads. They hold
+# no connection themselves: each thread borrows one from the database's
+# connection pool, so the schema setup only runs once
 resource_manager = None
 db = None
+repositories_lock = threading.Lock()
 
 # Create a function to get the resource manager
 def get_resource_manager():
-    """Get a resource manager instance for the current request."""
+    """Get the shared resource manager instance."""
     global resource_manager
     if resource_manager is None:
-        resource_manager = ResourceManager()
+        with repositories_lock:
+            if resource_manager is None:
+                resource_manager = ResourceManager(retrieval_backend=KNOWLEDGE_RETRIEVAL_BACKEND)
     return resource_manager
 
 # Create a function to get the database
 def get_db():
-    """Get a database instance for the current request."""
+    """Get the shared database instance."""
     global db
     if db is None:
-        db = OCRCSDatabase()
-        
-        # Add monkey patching for basic OCRCSDatabase class to support user verification
-        if not hasattr(db, 'verify_session_ownership'):
-            def verify_session_ownership(self, session_id, user_id):
-                """Check if a session belongs to a user - basic implementation always returns True."""
-                return True
-            db.verify_session_ownership = verify_session_ownership.__get__(db)
+        with repositories_lock:
+            if db is None:
+                database = OCRCSDatabase()
+                
+                # Add monkey patching for basic OCRCSDatabase class to support user verification
+                if not hasattr(database, 'verify_session_ownership'):
+                    def verify_session_ownership(self, session_id, user_id):
+                        """Check if a session belongs to a user - basic implementation always returns True."""
+                        return True
+                    database.verify_session_ownership = verify_session_ownership.__get__(database)
+                
+                db = database
     
     return db
 
-# Register teardown function to close connections
+# Register teardown function to return connections to their pools
 @app.teardown_appcontext
 def close_connections(exception):
-    """Close database connections when the request ends."""
-    global resource_manager, db
-    if resource_manager is not None:
-        resource_manager.close()
-        resource_manager = None
-    if db is not None:
-        db.close()
-        db = None
+    """Return this thread's database connections to the pool when the request ends."""
+    release_connections()
 
 # Load environment variables
 load_dotenv()
 
+# Knowledge retrieval backend: "fts" (keyword search), "vector" (local semantic
+# search, requires NumPy) or "topic" (all passages for the topic)
+KNOWLEDGE_RETRIEVAL_BACKEND = os.getenv("KNOWLEDGE_RETRIEVAL_BACKEND", "fts")
+
+# Answer cache: reuse answers to near-duplicate questions in the same topic and mode.
+# Off unless enabled; the threshold is the minimum similarity (0-1) of the questions
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.8"))
+
+# Replies given instead of an answer when the API call fails
+RATE_LIMIT_MESSAGE = "I've reached my rate limit. Please wait a moment before trying again."
+ERROR_MESSAGE = "Sorry, I couldn't generate a response at this time."
+
+# Size of the pieces a cached answer is sent in, so it arrives like a live one
+CACHED_RESPONSE_CHUNK_CHARS = 200
+
+# Number of recent general chat messages sent to the model with each question
+GLOBAL_CHAT_HISTORY_MESSAGES = 10
+
+# Kinds of pending streaming request each EventSource endpoint can pick up
+STUDENT_STREAM_KINDS = ('student_chat', 'initial_prompt')
+GLOBAL_STREAM_KINDS = ('global_chat',)
+
+# Anthropic API client settings: timeouts (in seconds) and how many times a request
+# that is rate limited, overloaded or fails to connect is retried
+ANTHROPIC_TIMEOUT = float(os.getenv("ANTHROPIC_TIMEOUT", "60"))
+ANTHROPIC_CONNECT_TIMEOUT = float(os.getenv("ANTHROPIC_CONNECT_TIMEOUT", "5"))
+ANTHROPIC_MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "4"))
+
+# Retry backoff: a random delay up to a limit that starts at the base and doubles on
+# each attempt, never more than the maximum (unless the API asks for longer)
+ANTHROPIC_BACKOFF_BASE = float(os.getenv("ANTHROPIC_BACKOFF_BASE", "1"))
+ANTHROPIC_BACKOFF_MAX = float(os.getenv("ANTHROPIC_BACKOFF_MAX", "30"))
+
+# Longest retry-after delay from the API that is honoured
+ANTHROPIC_RETRY_AFTER_MAX = 60
+
+# One client per process, so its HTTP connections are kept alive and reused
+anthropic_client = None
+anthropic_client_lock = threading.Lock()
+
+def anthropic_client_options():
+    """Settings shared by the blocking and asynchronous Anthropic clients."""
+    return {
+        'timeout': anthropic.Timeout(ANTHROPIC_TIMEOUT, connect=ANTHROPIC_CONNECT_TIMEOUT),
+        # Retries are handled by create_message, with full jitter
+        'max_retries': 0
+    }
+
 # Set up Anthropic API client
 def get_anthropic_client():
+    """Get the shared Anthropic API client."""
+    global anthropic_client
     api_key = os.getenv("ANTHROPIC_API_KEY")
     if not api_key:
         print("WARNING: ANTHROPIC_API_KEY environment variable is not set or empty")
         return None
-    return anthropic.Anthropic(api_key=api_key)
+    if anthropic_client is None:
+        with anthropic_client_lock:
+            if anthropic_client is None:
+                anthropic_client = anthropic.Anthropic(api_key=api_key, **anthropic_client_options())
+    return anthropic_client
+
+def is_retryable_error(error):
+    """Check if a failed API request is worth retrying."""
+    if isinstance(error, anthropic.APIConnectionError):  # Includes timeouts
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retrying a failed API request.
+    
+    Uses the API's retry-after header if it sent one, otherwise exponential backoff
+    with full jitter, so a class of students hitting a rate limit together don't
+    all retry at the same moment.
+    """
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            if 'retry-after-ms' in response.headers:
+                return min(float(response.headers['retry-after-ms']) / 1000, ANTHROPIC_RETRY_AFTER_MAX)
+            if 'retry-after' in response.headers:
+                return min(float(response.headers['retry-after']), ANTHROPIC_RETRY_AFTER_MAX)
+        except ValueError:
+            pass  # An HTTP date rather than a number of seconds
+    
+    return random.uniform(0, min(ANTHROPIC_BACKOFF_MAX, ANTHROPIC_BACKOFF_BASE * 2 ** attempt))
+
+def create_message(client, **kwargs):
+    """Call the Messages API, retrying rate-limited and failed requests.
+    
+    For streamed requests this retries opening the stream, not errors part way through it.
+    """
+    for attempt in range(ANTHROPIC_MAX_RETRIES + 1):
+        try:
+            return client.messages.create(**kwargs)
+        except anthropic.APIError as e:
+            if attempt == ANTHROPIC_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            delay = retry_delay(e, attempt)
+            print(f"API request failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+# Admission control for API calls: at most this many run at once in this process, and
+# at most LLM_MAX_PER_USER for any one student. Set LLM_MAX_CONCURRENT so that it times
+# the number of worker processes stays just under the API's concurrency limit
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "8"))
+LLM_MAX_PER_USER = int(os.getenv("LLM_MAX_PER_USER", "1"))
+
+# Longest a request waits in the queue (in seconds) before the student is told to try again
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "120"))
+
+# How often a queued stream checks its position in the queue
+LLM_QUEUE_POLL_INTERVAL = 0.5
+
+class LLMQueueTimeout(Exception):
+    """A request waited too long in the queue for an API call slot."""
+
+class LLMTicket:
+    """A request's place in the queue for an API call slot."""
+    
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.deadline = time.monotonic() + LLM_QUEUE_TIMEOUT
+        self.granted = threading.Event()
+        self.released = False
+
+class LLMConcurrencyLimiter:
+    """Process-wide limit on concurrent Messages API calls, with a queue.
+    
+    Requests are admitted first come, first served, except that a request whose
+    student already has max_per_user calls running is passed over until one of
+    them finishes, so one student can't hold up the rest of the class.
+    """
+    
+    def __init__(self, max_concurrent, max_per_user):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.running = 0
+        self.running_by_user = {}
+    
+    def enqueue(self, user_id):
+        """Join the queue; the ticket is granted straight away if a slot is free."""
+        ticket = LLMTicket(user_id)
+        with self.lock:
+            self.waiting.append(ticket)
+            self.admit()
+        return ticket
+    
+    def admit(self):
+        """Grant slots to waiting tickets. Must be called with the lock held."""
+        for ticket in list(self.waiting):
+            if self.running >= self.max_concurrent:
+                break
+            if self.running_by_user.get(ticket.user_id, 0) >= self.max_per_user:
+                continue
+            self.waiting.remove(ticket)
+            self.running += 1
+            self.running_by_user[ticket.user_id] = self.running_by_user.get(ticket.user_id, 0) + 1
+            ticket.granted.set()
+    
+    def position(self, ticket):
+        """The ticket's 1-based place in the queue, or 0 once it has a slot."""
+        with self.lock:
+            try:
+                return self.waiting.index(ticket) + 1
+            except ValueError:
+                return 0
+    
+    def release(self, ticket):
+        """Give up a ticket's slot, or its place in the queue. Safe to call more than once."""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted.is_set():
+                self.running -= 1
+                self.running_by_user[ticket.user_id] -= 1
+                if not self.running_by_user[ticket.user_id]:
+                    del self.running_by_user[ticket.user_id]
+            else:
+                self.waiting.remove(ticket)
+            self.admit()
+    
+    def stats(self):
+        """Current number of running and queued calls."""
+        with self.lock:
+            return {'running': self.running, 'queued': len(self.waiting)}
+
+llm_limiter = LLMConcurrencyLimiter(LLM_MAX_CONCURRENT, LLM_MAX_PER_USER)
+
+def queue_positions(ticket):
+    """Wait for a ticket to be granted, yielding its queue position whenever it changes.
+    
+    Raises LLMQueueTimeout if it isn't granted within LLM_QUEUE_TIMEOUT.
+    """
+    last_position = None
+    while not ticket.granted.is_set():
+        if time.monotonic() >= ticket.deadline:
+            raise LLMQueueTimeout()
+        position = llm_limiter.position(ticket)
+        if position and position != last_position:
+            last_position = position
+            yield position
+        ticket.granted.wait(LLM_QUEUE_POLL_INTERVAL)
+
+@contextmanager
+def llm_slot(user_id):
+    """Hold an API call slot for the duration of a blocking call, queueing for one if needed."""
+    ticket = llm_limiter.enqueue(user_id)
+    try:
+        for _ in queue_positions(ticket):
+            pass
+        yield
+    finally:
+        llm_limiter.release(ticket)
+
+def queue_events(ticket):
+    """Wait for a streaming request's slot, sending its queue position to the browser.
+    
+    Returns False, after sending the rate limit message as the reply, if the wait timed out.
+    """
+    try:
+        for position in queue_positions(ticket):
+            yield f"data: {json.dumps({'queued': True, 'position': position})}\n\n"
+    except LLMQueueTimeout:
+        yield f"data: {json.dumps({'done': True, 'full_response': RATE_LIMIT_MESSAGE})}\n\n"
+        return False
+    return True
 
 def is_api_key_set():
     """Check if the Anthropic API key is set."""
     api_key = os.getenv("ANTHROPIC_API_KEY")
     return api_key is not None and api_key.strip() != ""
 
+# Prompt caching: the API caches the prompt up to each block marked with this, so
+# follow-up requests sharing that prefix skip reprocessing it
+CACHE_CONTROL = {"type": "ephemeral"}
+
+def cacheable_text(text):
+    """Create a text block that ends a cacheable prompt prefix."""
+    return {"type": "text", "text": text, "cache_control": CACHE_CONTROL}
+
+def with_cached_history(messages):
+    """Mark the end of the conversation history (before the new question) as cacheable.
+    
+    The next turn sends the same history plus one exchange, so it reads this prefix
+    from the cache. The message dicts are copied, not modified.
+    """
+    messages = list(messages)
+    if len(messages) >= 2 and isinstance(messages[-2]["content"], str):
+        messages[-2] = {"role": messages[-2]["role"], "content": [cacheable_text(messages[-2]["content"])]}
+    return messages
+
+def usage_counts(usage):
+    """Get the token counts from an API usage object."""
+    return {
+        'input_tokens': usage.input_tokens or 0,
+        'output_tokens': usage.output_tokens or 0,
+        'cache_read_tokens': getattr(usage, 'cache_read_input_tokens', None) or 0,
+        'cache_creation_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0
+    }
+
+def update_stream_usage(usage, chunk):
+    """Collect the token counts reported by the events of a streamed response."""
+    if chunk.type == "message_start":
+        return usage_counts(chunk.message.usage)
+    if chunk.type == "message_delta" and usage is not None:
+        usage['output_tokens'] = chunk.usage.output_tokens
+    return usage
+
+def record_usage(endpoint, usage):
+    """Record the token usage of a request, including prompt cache reads and writes."""
+    if not usage:
+        return
+    print(f"[{endpoint}] cache read: {usage['cache_read_tokens']}, cache write: {usage['cache_creation_tokens']}, "
+          f"uncached input: {usage['input_tokens']}, output: {usage['output_tokens']} tokens")
+    try:
+        get_db().record_api_usage(endpoint, AI_MODEL, **usage)
+    except sqlite3.Error as e:
+        print(f"Error recording API usage: {e}")
+
 # Database functions for user management
 def init_user_db():
     """Initialize the user database tables if they don't exist."""
-    conn = sqlite3.connect('user_database.db')
+    conn = get_connection_pool(USER_DB_PATH).connection()
     cursor = conn.cursor()
     
     # Create users table
@@ -152,59 +435,190 @@ def init_user_db():
             print(f"Error modifying sessions table: {e}")
     
     conn.commit()
-    conn.close()
+
+# User records are cached in each process for this many seconds, so a burst of logins
+# and page loads at the start of a lesson doesn't query the user database every time
+USER_CACHE_TTL = 60
+USER_CACHE_MAX_ENTRIES = 2000
+
+class UserRepository:
+    """User accounts in the user database, with a short-lived in-process cache.
+    
+    Records are cached by ID and by email. Writes made through the repository clear
+    the cached copies; changes made by other processes show up within USER_CACHE_TTL.
+    Records are (id, email, password_hash, full_name, role) tuples.
+    """
+    
+    COLUMNS = "id, email, password_hash, full_name, role"
+    
+    def __init__(self, db_path=USER_DB_PATH, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.pool = get_connection_pool(db_path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache = {}
+        self.lock = threading.Lock()
+    
+    def cached(self, key):
+        """Get a cached record, or None if it isn't cached or has expired."""
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.cache[key]
+                return None
+            return entry[1]
+    
+    def remember(self, user):
+        """Cache a record under its ID and email."""
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            # Evict the oldest entries when the cache is full
+            while len(self.cache) >= self.max_entries:
+                del self.cache[next(iter(self.cache))]
+            self.cache[('id', user[0])] = (expires, user)
+            self.cache[('email', user[1])] = (expires, user)
+    
+    def forget(self, user_id=None, email=None):
+        """Clear the cached copies of a user's record."""
+        with self.lock:
+            entry = self.cache.pop(('id', user_id), None) or self.cache.pop(('email', email), None)
+            if entry:
+                self.cache.pop(('id', entry[1][0]), None)
+                self.cache.pop(('email', entry[1][1]), None)
+    
+    def find(self, key, column, value):
+        """Get a user by a unique column, from the cache if possible."""
+        user = self.cached(key)
+        if user is None:
+            cursor = self.pool.connection().cursor()
+            cursor.execute(f"SELECT {self.COLUMNS} FROM users WHERE {column} = ?", (value,))
+            user = cursor.fetchone()
+            if user:
+                self.remember(user)
+        return user
+    
+    def get_by_email(self, email):
+        """Get a user by email."""
+        return self.find(('email', email), 'email', email)
+    
+    def get_by_id(self, user_id):
+        """Get a user by ID."""
+        return self.find(('id', user_id), 'id', user_id)
+    
+    def create(self, email, password_hash, full_name, role='student'):
+        """Add a user. Returns the new user's ID, or None if the email is already registered."""
+        conn = self.pool.connection()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO users (email, password_hash, full_name, role) VALUES (?, ?, ?, ?)",
+                (email, password_hash, full_name, role)
+            )
+            conn.commit()
+        except sqlite3.IntegrityError as e:
+            conn.rollback()
+            if "users.email" in str(e):
+                return None
+            raise
+        self.forget(cursor.lastrowid, email)
+        return cursor.lastrowid
+
+user_repository = UserRepository()
+
+# Password hashing and checking run on their own small thread pool, so a class logging
+# in at once can't starve chat requests of CPU. The method sets the work factor, e.g.
+# "scrypt:32768:8:1" or "pbkdf2:sha256:600000" (empty uses werkzeug's default)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "")
+
+class PasswordHasher:
+    """Runs the deliberately slow password hash functions on a bounded thread pool.
+    
+    The calling request thread waits for the result without using CPU. How long jobs
+    wait for a worker and how long they take is recorded for the admin stats.
+    """
+    
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, method=PASSWORD_HASH_METHOD):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.method = method
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.total_work_time = 0.0
+    
+    def run(self, func, *args, **kwargs):
+        """Run a function on the pool and wait for its result."""
+        submitted = time.monotonic()
+        
+        def job():
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(started - submitted, time.monotonic() - started)
+        
+        return self.executor.submit(job).result()
+    
+    def record(self, queue_time, work_time):
+        """Add one job's timings to the totals."""
+        with self.lock:
+            self.jobs += 1
+            self.total_queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            self.total_work_time += work_time
+    
+    def hash(self, password):
+        """Hash a password with the configured method."""
+        if self.method:
+            return self.run(generate_password_hash, password, method=self.method)
+        return self.run(generate_password_hash, password)
+    
+    def check(self, password_hash, password):
+        """Check a password against its stored hash."""
+        return self.run(check_password_hash, password_hash, password)
+    
+    def stats(self):
+        """Job count and average and longest queue times, in milliseconds."""
+        with self.lock:
+            return {
+                'jobs': self.jobs,
+                'avg_queue_ms': 1000 * self.total_queue_time / self.jobs if self.jobs else None,
+                'max_queue_ms': 1000 * self.max_queue_time,
+                'avg_hash_ms': 1000 * self.total_work_time / self.jobs if self.jobs else None
+            }
+
+password_hasher = PasswordHasher()
 
 def get_user_by_email(email):
     """Get a user from the database by email."""
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    return user_repository.get_by_email(email)
 
 def get_user_by_id(user_id):
     """Get a user from the database by ID."""
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    return user_repository.get_by_id(user_id)
 
 def create_user(email, password, full_name, role='student'):
     """Create a new user in the database."""
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    
-    # Check if user already exists
-    cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
-    if cursor.fetchone():
-        conn.close()
-        return False, "Email already registered"
-    
     # Hash the password before storing
-    password_hash = generate_password_hash(password)
+    password_hash = password_hasher.hash(password)
     
     try:
-        cursor.execute(
-            "INSERT INTO users (email, password_hash, full_name, role) VALUES (?, ?, ?, ?)",
-            (email, password_hash, full_name, role)
-        )
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
-        return True, user_id
+        # A single insert: the unique email column rejects duplicates
+        user_id = user_repository.create(email, password_hash, full_name, role)
     except Exception as e:
-        conn.rollback()
-        conn.close()
         return False, str(e)
+    if user_id is None:
+        return False, "Email already registered"
+    return True, user_id
 
 # Authentication decorators
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not session.get('user_id'):
+        # The account is checked too (usually from the user cache), so a deleted user is logged out
+        user_id = session.get('user_id')
+        if not user_id or get_user_by_id(user_id) is None:
             flash('Please log in to access this page', 'error')
             return redirect(url_for('student_login'))
         return f(*args, **kwargs)
@@ -318,79 +732,147 @@ def create_system_prompt():
     return system_prompt.strip()
 
 # Get response from Claude
-def get_claude_response(prompt, conversation_history=None, topic_code=None, stream=False, mode="explore"):
-    """Get a response from Claude based on the prompt, conversation history, and knowledge base."""
-    try:
-        client = get_anthropic_client()
+def build_chat_request(prompt, conversation_history=None, topic_code=None, mode="explore", summary=None):
+    """Build the Messages API arguments for a topic chat turn.
+    
+    The prompt is assembled within the input token budget: the system prompt and
+    question first, then the reference material, then the summary of earlier turns
+    and as much of the recent conversation as fits. Shared by the blocking Flask responses and the
+    asynchronous streaming server.
+    """
+    budget = PromptBudget()
+    
+    # The system prompt never changes, so it is always a cacheable prefix
+    system_prompt = budget.add_required("system", create_system_prompt())
+    system = [cacheable_text(system_prompt)]
+    
+    # The question always goes in whole
+    budget.add_required("question", prompt)
+    
+    # Augment prompt with knowledge base information if available
+    augmented_prompt = prompt
+    if topic_code:
+        rm = get_resource_manager()
         
-        messages = []
+        # The resource written for the topic is the same on every turn, so it goes
+        # in the cached prefix after the system prompt
+        topic_reference = budget.fit_passages(
+            "reference", rm.get_topic_document(topic_code, max_chars=TOPIC_REFERENCE_MAX_CHARS)
+        )
+        if topic_reference:
+            topic_reference_text = "\n\n".join(topic_reference)
+            system.append(cacheable_text(f"""[REFERENCE INFORMATION]
+The following information is from OCR A-Level Computer Science resources related to topic {topic_code}:
+
+{topic_reference_text}
+
+[END REFERENCE INFORMATION]"""))
         
-        # Include conversation history if provided
-        if conversation_history:
-            messages = conversation_history.copy()
+        # Only include the passages most relevant to the question, unless they
+        # are already in the topic reference, while the reference share lasts
+        knowledge = budget.fit_passages("reference", [
+            passage for passage in rm.retrieve_knowledge(prompt, topic_code)
+            if passage not in topic_reference
+        ])
         
-        # Augment prompt with knowledge base information if available
-        augmented_prompt = prompt
-        if topic_code and resource_manager:
-            knowledge = resource_manager.get_knowledge_for_topic(topic_code)
+        if knowledge:
+            knowledge_text = "\n\n".join(knowledge)
             
-            if knowledge:
-                # Summarize knowledge to avoid exceeding context limits
-                knowledge_text = "\n\n".join(knowledge)
-                if len(knowledge_text) > 10000:  # Limit knowledge text size
-                    knowledge_text = knowledge_text[:10000] + "..."
-                
-                augmented_prompt = f"""
-                [REFERENCE INFORMATION]
-                The following information is from OCR A-Level Computer Science resources related to topic {topic_code}:
-                
-                {knowledge_text}
-                
-                [END REFERENCE INFORMATION]
-                
-                STUDENT QUESTION:
-                {prompt}
-                
-                Please use the reference information where appropriate to give an accurate, specification-aligned response.
-                """
+            augmented_prompt = f"""
+            [REFERENCE INFORMATION]
+            The following information is from OCR A-Level Computer Science resources related to topic {topic_code}:
+            
+            {knowledge_text}
+            
+            [END REFERENCE INFORMATION]
+            
+            STUDENT QUESTION:
+            {prompt}
+            
+            Please use the reference information where appropriate to give an accurate, specification-aligned response.
+            """
+    
+    # Append mode tag to the prompt
+    augmented_prompt = f"{augmented_prompt}\n\n[MODE: {mode}]"
+    
+    # The summary of earlier turns has its own share, so trimming the history to fit
+    # never cuts it
+    if summary:
+        summary = budget.fit_text("summary", summary)
+    
+    # Include as much of the conversation history as fits
+    messages = budget.fit_history(conversation_history or [])
+    
+    # Add the current prompt, then put the summary in front of the conversation
+    messages.append({"role": "user", "content": augmented_prompt})
+    messages = with_summary(messages, summary)
+    
+    return {
+        'model': AI_MODEL,
+        'max_tokens': 2048,
+        'temperature': 0.7,
+        'system': system,
+        'messages': with_cached_history(messages)
+    }
+
+def get_claude_response(prompt, conversation_history=None, topic_code=None, stream=False, mode="explore", user_id=None, summary=None):
+    """Get a response from Claude based on the prompt, conversation history, and knowledge base.
+    
+    A blocking call waits for an API call slot for user_id; a streamed one is returned
+    as soon as it opens, so the caller must already hold a slot for it. Errors opening
+    a stream (including running out of rate limit retries) are raised to the caller.
+    """
+    if stream:
+        # Return the stream directly for streaming response
+        client = get_anthropic_client()
+        request_args = build_chat_request(prompt, conversation_history, topic_code, mode, summary)
+        return create_message(client, stream=True, **request_args)
+    
+    try:
+        client = get_anthropic_client()
+        request_args = build_chat_request(prompt, conversation_history, topic_code, mode, summary)
         
-        # Append mode tag to the prompt
-        augmented_prompt = f"{augmented_prompt}\n\n[MODE: {mode}]"
+        # Non-streaming response
+        with llm_slot(user_id):
+            response = create_message(client, **request_args)
+        record_usage("student_chat", usage_counts(response.usage))
         
-        # Add the current prompt
-        messages.append({"role": "user", "content": augmented_prompt})
+        # Get the response text
+        response_text = response.content[0].text
         
-        # Create a message and get the response
-        if stream:
-            # Return the stream directly for streaming response
-            return client.messages.create(
-                model=AI_MODEL,
-                max_tokens=2048,
-                temperature=0.7,
-                system=create_system_prompt(),
-                messages=messages,
-                stream=True
-            )
-        else:
-            # Non-streaming response
-            response = client.messages.create(
-                model=AI_MODEL,
-                max_tokens=2048,
-                temperature=0.7,
-                system=create_system_prompt(),
-                messages=messages
-            )
-            
-            # Get the response text
-            response_text = response.content[0].text
-            
-            return response_text
+        return response_text
         
-    except anthropic.RateLimitError:
-        return "I've reached my rate limit. Please wait a moment before trying again."
+    except (anthropic.RateLimitError, LLMQueueTimeout):
+        return RATE_LIMIT_MESSAGE
     except Exception as e:
         print(f"Error: {str(e)}")
-        return "Sorry, I couldn't generate a response at this time."
+        return ERROR_MESSAGE
+
+def compact_session_history(database, session_id, user_id=None):
+    """Fold the older turns of a long session into its stored summary."""
+    client = get_anthropic_client()
+    if client is None:
+        return
+    
+    def summarize(summary, messages):
+        with llm_slot(user_id):
+            return summarize_conversation(client, AI_MODEL, summary, messages)
+    
+    database.compact_session(session_id, summarize)
+
+def initial_response_cache_key(topic_code, mode, initial_prompt):
+    """Key for the cached answers to a topic's opening prompt.
+    
+    The prompt template and system prompt are hashed in, so editing either
+    stops old answers being used.
+    """
+    template_hash = hashlib.sha256((create_system_prompt() + initial_prompt).encode("utf-8")).hexdigest()
+    return hashlib.sha256(json.dumps([topic_code, mode, AI_MODEL, template_hash]).encode("utf-8")).hexdigest()
+
+def cached_response_chunks(response):
+    """Split a cached answer into pieces to send as separate stream events."""
+    for start in range(0, len(response), CACHED_RESPONSE_CHUNK_CHARS):
+        yield response[start:start + CACHED_RESPONSE_CHUNK_CHARS]
 
 # Create initial prompt based on topic and mode
 def create_initial_prompt(component, main_topic, detailed_topic, mode):
@@ -532,52 +1014,13 @@ Keep the questions realistic in scope and length to simulate an actual OCR exam.
 def initialize_db():
     """Initialize database tables"""
     init_user_db()
-
-# Function to migrate database schema
-def migrate_database():
-    """Apply database migrations to add new columns to existing tables"""
-    print("Running database migrations...")
-    try:
-        conn = sqlite3.connect('ocr_cs_tutor.db')
-        cursor = conn.cursor()
-        
-        # Check if user_id column exists in topic_progress table
-        cursor.execute("PRAGMA table_info(topic_progress)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        if 'user_id' not in column_names and columns:
-            print("Adding user_id column to topic_progress table")
-            cursor.execute("ALTER TABLE topic_progress ADD COLUMN user_id INTEGER")
-        
-        # Check if user_id column exists in sessions table
-        cursor.execute("PRAGMA table_info(sessions)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        if 'user_id' not in column_names and columns:
-            print("Adding user_id column to sessions table")
-            cursor.execute("ALTER TABLE sessions ADD COLUMN user_id INTEGER")
-        
-        # Check if user_id column exists in exam_practice table
-        cursor.execute("PRAGMA table_info(exam_practice)")
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        if 'user_id' not in column_names and columns:
-            print("Adding user_id column to exam_practice table")
-            cursor.execute("ALTER TABLE exam_practice ADD COLUMN user_id INTEGER")
-        
-        conn.commit()
-        conn.close()
-        print("Database migrations completed successfully")
-    except sqlite3.Error as e:
-        print(f"Database migration error: {e}")
+    
+    # Creating the tutor database applies any pending schema migrations
+    get_db()
 
 # Create initialization function for database
 with app.app_context():
     initialize_db()
-    migrate_database()
 
 @app.route('/')
 def index():
@@ -625,7 +1068,7 @@ def student_login():
         # Get user from database
         user = get_user_by_email(email)
         
-        if user and check_password_hash(user[2], password):  # Index 2 is password_hash
+        if user and password_hasher.check(user[2], password):  # Index 2 is password_hash
             # Set session
             session['user_id'] = user[0]  # Index 0 is id
             session['user_email'] = user[1]  # Index 1 is email
@@ -683,6 +1126,41 @@ def admin_resources():
     files = rm.get_all_file_info()
     return render_template('admin/resources.html', files=files)
 
+@app.route('/admin/cache-stats')
+@admin_required
+def admin_cache_stats():
+    """Prompt cache hits and misses and token usage for each endpoint, answer cache hit rate,
+    the number of API calls running and queued in this process, and password hashing times."""
+    database = get_db()
+    stats = []
+    for endpoint, requests_count, hits, misses, input_tokens, output_tokens, cache_read, cache_creation in database.get_api_usage_stats():
+        stats.append({
+            'endpoint': endpoint,
+            'requests': requests_count,
+            'cache_hits': hits,
+            'cache_misses': misses,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'cache_read_tokens': cache_read,
+            'cache_creation_tokens': cache_creation
+        })
+    
+    answer_hits, answer_misses = database.get_answer_cache_stats()
+    lookups = answer_hits + answer_misses
+    answer_cache = {
+        'enabled': ANSWER_CACHE_ENABLED,
+        'threshold': ANSWER_CACHE_THRESHOLD,
+        'hits': answer_hits,
+        'misses': answer_misses,
+        'hit_rate': answer_hits / lookups if lookups else None
+    }
+    return jsonify({
+        'stats': stats,
+        'answer_cache': answer_cache,
+        'llm_queue': llm_limiter.stats(),
+        'password_hashing': password_hasher.stats()
+    })
+
 @app.route('/admin/upload', methods=['GET', 'POST'])
 @admin_required
 def admin_upload():
@@ -723,8 +1201,8 @@ def admin_upload():
                 file.save(temp_path)
                 print(f"File saved to: {temp_path}")
                 
-                # Process file
-                file_id = rm.add_file(temp_path, category)
+                # Process file - the upload is moved into the resource directory rather than copied
+                file_id = rm.add_file(temp_path, category, move=True)
                 print(f"File ID: {file_id}")
                 
                 if file_id:
@@ -733,7 +1211,7 @@ def admin_upload():
                 else:
                     duplicate_count += 1
                 
-                # Remove temporary file
+                # Remove temporary file if it was a duplicate and not moved
                 if os.path.exists(temp_path):
                     os.remove(temp_path)
             except Exception as e:
@@ -807,10 +1285,6 @@ def student_topic(component, topic_code):
 @login_required
 def student_initial_prompt():
     """API endpoint for getting initial prompt based on topic and mode."""
-    # Global dict to store pending requests
-    if not hasattr(app, 'pending_initial_prompt_requests'):
-        app.pending_initial_prompt_requests = {}
-    
     try:
         data = request.json
         topic_code = data.get('topic_code')
@@ -923,27 +1397,38 @@ def student_initial_prompt():
         # Add user message to database
         database.add_message(session_id, "user", initial_prompt)
         
+        # Every student opening this topic in this mode gets the same prompt, so
+        # the answer can usually come from the cache
+        cache_key = initial_response_cache_key(topic_code, mode, initial_prompt)
+        cached_response = database.get_cached_initial_response(cache_key)
+        if cached_response:
+            database.add_message(session_id, "assistant", cached_response)
+        
         # If streaming is requested, use the same pattern as student_chat
         if stream_mode and request_id:
             # Store the request data for the streaming endpoint to pick up
-            request_key = f"{user_id}:{request_id}"
-            app.pending_initial_prompt_requests[request_key] = {
+            database.store_pending_request('initial_prompt', f"{user_id}:{request_id}", {
                 'question': initial_prompt,
                 'conversation_history': [{"role": "user", "content": initial_prompt}],
                 'topic_code': topic_code,
                 'mode': mode,
                 'session_id': session_id,
-                'timestamp': time.time()
-            }
+                'cache_key': cache_key,
+                'cached_response': cached_response
+            })
             
             # Return successful acknowledgement - client will connect to SSE endpoint
             return jsonify({'success': True, 'streaming': True})
+        elif cached_response:
+            return jsonify({'response': cached_response})
         else:
             # Non-streaming response (original functionality)
-            response = get_claude_response(initial_prompt, topic_code=topic_code, mode=mode)
+            response = get_claude_response(initial_prompt, topic_code=topic_code, mode=mode, user_id=user_id)
             
             # Add assistant message to database
             database.add_message(session_id, "assistant", response)
+            if response not in (RATE_LIMIT_MESSAGE, ERROR_MESSAGE):
+                database.cache_initial_response(cache_key, response)
             
             return jsonify({'response': response})
     except Exception as e:
@@ -951,70 +1436,106 @@ def student_initial_prompt():
         return jsonify({'error': f'Error generating initial response: {str(e)}'}), 500
 
 # Function to generate streaming response for student chat
-def generate_student_chat_stream(question, conversation_history, topic_code=None, mode="explore"):
-    """Generate streaming response for topic-specific student chat."""
-    client = get_anthropic_client()
-    
-    # Get streaming response
-    response_stream = get_claude_response(question, conversation_history, topic_code, stream=True, mode=mode)
+def save_streamed_response(session_id, response):
+    """Store a streamed assistant reply, or as much of it as was generated."""
+    if session_id and response:
+        get_db().add_message(session_id, "assistant", response)
+
+def generate_cached_stream(response):
+    """Replay a cached answer with the same events as a live stream."""
+    for text in cached_response_chunks(response):
+        yield f"data: {json.dumps({'text': text})}\n\n"
     
-    # Track full response for conversation history
-    full_response = ""
+    yield f"data: {json.dumps({'done': True, 'full_response': response})}\n\n"
+
+def generate_student_chat_stream(question, conversation_history, topic_code=None, mode="explore", session_id=None, cache_key=None, answer_cache=False, user_id=None, summary=None):
+    """Generate streaming response for topic-specific student chat.
     
-    # Stream each chunk as it comes
-    for chunk in response_stream:
-        if chunk.type == "content_block_delta":
-            text = chunk.delta.text
-            if text:  # Only send non-empty text
-                full_response += text
-                yield f"data: {json.dumps({'text': text})}\n\n"
+    If a cache_key is given, the complete answer is added to the initial response cache;
+    if answer_cache is set, it is added to the answer cache.
+    """
+    # Wait for an API call slot, telling the student their place in the queue
+    ticket = llm_limiter.enqueue(user_id)
+    try:
+        if not (yield from queue_events(ticket)):
+            return
+        
+        # Get streaming response
+        try:
+            response_stream = get_claude_response(question, conversation_history, topic_code, stream=True, mode=mode, summary=summary)
+        except anthropic.RateLimitError:
+            yield f"data: {json.dumps({'done': True, 'full_response': RATE_LIMIT_MESSAGE})}\n\n"
+            return
+        except anthropic.APIError as e:
+            # Out of retries for an overloaded or unreachable API
+            print(f"Error opening stream: {str(e)}")
+            yield f"data: {json.dumps({'done': True, 'full_response': ERROR_MESSAGE})}\n\n"
+            return
+        
+        # Track full response for conversation history
+        full_response = ""
+        usage = None
+        
+        try:
+            # Stream each chunk as it comes
+            for chunk in response_stream:
+                usage = update_stream_usage(usage, chunk)
+                if chunk.type == "content_block_delta":
+                    text = chunk.delta.text
+                    if text:  # Only send non-empty text
+                        full_response += text
+                        yield f"data: {json.dumps({'text': text})}\n\n"
+            
+            record_usage("student_chat", usage)
+            
+            if cache_key and full_response:
+                get_db().cache_initial_response(cache_key, full_response)
+            if answer_cache and full_response:
+                get_db().cache_answer(topic_code, mode, question, full_response)
+        finally:
+            # The reply is saved here rather than posted back by the browser, so it is
+            # kept even if the student closes the page part way through
+            save_streamed_response(session_id, full_response)
+        
+        # Send the final response with the complete content
+        yield f"data: {json.dumps({'done': True, 'full_response': full_response})}\n\n"
+    finally:
+        llm_limiter.release(ticket)
     
-    # Send the final response with the complete content
-    yield f"data: {json.dumps({'done': True, 'full_response': full_response})}\n\n"
+    if session_id:
+        compact_session_history(get_db(), session_id, user_id)
 
 @app.route('/student/chat', methods=['POST', 'GET'])
 @login_required
 def student_chat():
     """API endpoint for chat interactions for the logged-in user."""
-    # Global dict to store pending requests
-    if not hasattr(app, 'pending_student_chat_requests'):
-        app.pending_student_chat_requests = {}
-    
     # Handle GET request for EventSource
     if request.method == 'GET':
         request_id = request.args.get('request_id')
         
         if request_id:
             user_id = session.get('user_id')
-            request_key = f"{user_id}:{request_id}"
             
-            # Check if this is a valid pending request in student chat
-            if request_key in app.pending_student_chat_requests:
-                request_data = app.pending_student_chat_requests[request_key]
-                
+            # Check if this is a valid pending chat or initial prompt request. Taking
+            # it removes it, so each request is only answered once
+            request_data = get_db().take_pending_request(STUDENT_STREAM_KINDS, f"{user_id}:{request_id}")
+            if request_data and request_data.get('cached_response'):
+                # Replay a cached answer to an opening prompt (already saved to the session)
+                return Response(generate_cached_stream(request_data['cached_response']), mimetype='text/event-stream')
+            elif request_data:
                 # Return SSE stream with the pending question data
                 return Response(
-                    generate_student_chat_stream(
-                        request_data['question'], 
-                        request_data['conversation_history'],
-                        request_data['topic_code'],
-                        request_data.get('mode', 'explore')
-                    ),
-                    mimetype='text/event-stream'
-                )
-            
-            # Check if this is a valid pending request for initial prompt
-            elif hasattr(app, 'pending_initial_prompt_requests') and request_key in app.pending_initial_prompt_requests:
-                request_data = app.pending_initial_prompt_requests[request_key]
-                
-                # Return SSE stream with the pending initial prompt data
-                return Response(
-                    generate_student_chat_stream(
+                    stream_with_context(generate_student_chat_stream(
                         request_data['question'], 
                         request_data['conversation_history'],
                         request_data['topic_code'],
-                        request_data.get('mode', 'explore')
-                    ),
+                        request_data.get('mode', 'explore'),
+                        request_data.get('session_id'),
+                        request_data.get('cache_key'),
+                        request_data.get('answer_cache', False),
+                        user_id,
+                        request_data.get('summary')
+                    )),
                     mimetype='text/event-stream'
                 )
         
@@ -1037,12 +1558,12 @@ def student_chat():
         # Get conversation history from database
         database = get_db()
         conversation_history = []
+        summary = None
         if session_id:
             # Verify this session belongs to the current user
             if database.verify_session_ownership(session_id, user_id):
-                messages = database.get_session_messages(session_id)
-                for _, role, content in messages:
-                    conversation_history.append({"role": role, "content": content})
+                # Only the most recent turns are sent, plus a summary of older ones
+                summary, conversation_history = database.get_history_window(session_id)
             else:
                 return jsonify({'error': 'Session not found or unauthorized'}), 403
         
@@ -1051,63 +1572,67 @@ def student_chat():
         if not api_key:
             return jsonify({'error': 'ANTHROPIC_API_KEY is not set. Please set it in the environment variables.'}), 500
         
+        # A question that doesn't build on the conversation (which so far is only
+        # the topic's opening exchange) can be answered from the answer cache. The
+        # whole session is counted, as the history sent is only its latest turns
+        use_answer_cache = bool(ANSWER_CACHE_ENABLED and topic_code) and \
+            database.count_user_messages(session_id) <= 1
+        cached_answer = None
+        if use_answer_cache:
+            cached_answer = database.find_cached_answer(topic_code, mode, question, ANSWER_CACHE_THRESHOLD)
+        
         # If streaming is requested, use Server-Sent Events
         if stream_mode:
             # Add user message to database
             if session_id:
                 database.add_message(session_id, "user", question)
+                if cached_answer:
+                    database.add_message(session_id, "assistant", cached_answer)
             
             # Get request ID from client
             request_id = data.get('request_id')
             
             if request_id:
                 # Store the request data for the streaming endpoint to pick up
-                request_key = f"{user_id}:{request_id}"
-                app.pending_student_chat_requests[request_key] = {
+                database.store_pending_request('student_chat', f"{user_id}:{request_id}", {
                     'question': question,
                     'conversation_history': conversation_history,
+                    'summary': summary,
                     'topic_code': topic_code,
                     'mode': mode,
                     'session_id': session_id,
-                    'timestamp': time.time()
-                }
+                    'answer_cache': use_answer_cache,
+                    'cached_response': cached_answer
+                })
                 
                 # Return successful acknowledgement - client will connect to SSE endpoint
                 return jsonify({'success': True, 'streaming': True})
+            elif cached_answer:
+                return Response(generate_cached_stream(cached_answer), mimetype='text/event-stream')
             else:
                 # For backward compatibility - use direct streaming if no request_id provided
-                # Store session_id in local variable for the closure
-                current_session_id = session_id
-                
-                # Function to generate SSE data
-                def generate():
-                    nonlocal current_session_id
-                    # Get streaming response
-                    response_stream = get_claude_response(question, conversation_history, topic_code, stream=True, mode=mode)
-                    
-                    # Track full response for database
-                    full_response = ""
-                    
-                    # Stream each chunk as it comes
-                    for chunk in response_stream:
-                        if chunk.type == "content_block_delta":
-                            text = chunk.delta.text
-                            if text:  # Only send non-empty text
-                                full_response += text
-                                yield f"data: {json.dumps({'text': text})}\n\n"
-                    
-                    # Signal the end of the stream with the full response
-                    yield f"data: {json.dumps({'done': True, 'full_response': full_response})}\n\n"
-                
-                return Response(generate(), mimetype='text/event-stream')
+                # The reply is streamed and saved the same way as for the EventSource requests
+                return Response(
+                    stream_with_context(generate_student_chat_stream(
+                        question, conversation_history, topic_code, mode, session_id,
+                        answer_cache=use_answer_cache, user_id=user_id, summary=summary
+                    )),
+                    mimetype='text/event-stream'
+                )
         else:
             # Non-streaming response (original functionality)
-            response = get_claude_response(question, conversation_history, topic_code, mode=mode)
+            if cached_answer:
+                response = cached_answer
+            else:
+                response = get_claude_response(question, conversation_history, topic_code, mode=mode, user_id=user_id, summary=summary)
+                if use_answer_cache and response not in (RATE_LIMIT_MESSAGE, ERROR_MESSAGE):
+                    database.cache_answer(topic_code, mode, question, response)
             
             # Add messages to database
             if session_id:
                 database.add_message(session_id, "user", question)
                 database.add_message(session_id, "assistant", response)
+                compact_session_history(database, session_id, user_id)
             
             return jsonify({'response': response})
             
@@ -1122,23 +1647,10 @@ def student_progress():
     user_id = session.get('user_id')
     database = get_db()
     
-    try:
-        # Try to filter by user_id
-        topic_progress = database.get_topic_progress(user_id=user_id)
-        exam_progress = database.get_exam_progress(user_id=user_id)
-    except (sqlite3.OperationalError, TypeError) as e:
-        # Fallback if we get "no such column" error or TypeError (when function doesn't accept user_id parameter)
-        if isinstance(e, sqlite3.OperationalError) and "no such column: user_id" in str(e):
-            print(f"Warning: User ID column missing - using unfiltered data: {e}")
-        elif isinstance(e, TypeError):
-            print(f"Warning: Database function doesn't accept user_id parameter: {e}")
-        # Fallback to unfiltered data
-        topic_progress = database.get_topic_progress()
-        exam_progress = database.get_exam_progress()
-    except Exception as e:
-        # Re-raise if it's some other error
-        print(f"Error in student_progress: {e}")
-        raise
+    # Both are indexed reads of this student's rows: exam averages are kept up to
+    # date as results are recorded, rather than worked out from every attempt
+    topic_progress = database.get_topic_progress(user_id=user_id)
+    exam_progress = database.get_exam_progress(user_id=user_id)
     
     return render_template('student/progress.html', 
                           topic_progress=topic_progress,
@@ -1160,21 +1672,35 @@ def student_rate_topic():
         return jsonify({'error': 'Missing required fields'})
     
     database = get_db()
-    try:
-        # Try to update with user_id
-        database.update_topic_progress(topic_code, topic_title, rating, notes, user_id=user_id)
-    except sqlite3.OperationalError as e:
-        # Fallback if we get "no such column" error
-        if "no such column: user_id" in str(e):
-            print(f"Warning: User ID column missing in topic_progress: {e}")
-            # Fallback to non-user-specific update
-            database.update_topic_progress(topic_code, topic_title, rating, notes)
-        else:
-            # Re-raise if it's some other database error
-            raise
+    database.update_topic_progress(topic_code, topic_title, rating, notes, user_id=user_id)
     
     return jsonify({'success': True})
 
+@app.route('/student/rate-topics', methods=['POST'])
+@login_required
+def student_rate_topics():
+    """Rate understanding of several topics at once for the logged-in user."""
+    data = request.json
+    user_id = session.get('user_id')
+    ratings = []
+    
+    for item in data.get('ratings') or []:
+        topic_code = item.get('topic_code')
+        topic_title = item.get('topic_title')
+        rating = item.get('rating')
+        if not topic_code or not topic_title or not rating:
+            return jsonify({'error': 'Missing required fields'})
+        ratings.append((topic_code, topic_title, rating, item.get('notes', '')))
+    
+    if not ratings:
+        return jsonify({'error': 'No ratings provided'})
+    
+    # All the ratings are written in one transaction
+    database = get_db()
+    database.update_topics_progress(ratings, user_id=user_id)
+    
+    return jsonify({'success': True, 'count': len(ratings)})
+
 @app.route('/student/record-exam', methods=['POST'])
 @login_required
 def student_record_exam():
@@ -1191,50 +1717,17 @@ def student_record_exam():
         return jsonify({'error': 'Missing required fields'})
     
     database = get_db()
-    try:
-        # Try to record with user_id
-        database.record_exam_practice(topic_code, question_type, difficulty, score, max_score, user_id=user_id)
-    except sqlite3.OperationalError as e:
-        # Fallback if we get "no such column" error
-        if "no such column: user_id" in str(e):
-            print(f"Warning: User ID column missing in exam_practice: {e}")
-            # Fallback to non-user-specific record
-            database.record_exam_practice(topic_code, question_type, difficulty, score, max_score)
-        else:
-            # Re-raise if it's some other database error
-            raise
+    database.record_exam_practice(topic_code, question_type, difficulty, score, max_score, user_id=user_id)
     
     return jsonify({'success': True})
 
-@app.route('/student/save-response', methods=['POST'])
-@login_required
-def save_response():
-    """Save complete Claude response to the database after streaming."""
-    data = request.json
-    session_id = data.get('session_id')
-    response = data.get('response')
-    user_id = session.get('user_id')
-    
-    if not session_id or not response:
-        return jsonify({'error': 'Missing required fields'}), 400
-    
-    # Get database
-    database = get_db()
-    
-    # Verify this session belongs to the current user
-    if database.verify_session_ownership(session_id, user_id):
-        # Save response to database
-        database.add_message(session_id, "assistant", response)
-        return jsonify({'success': True})
-    else:
-        return jsonify({'error': 'Session not found or unauthorized'}), 403
-
 @app.route('/student/get-recent-messages', methods=['POST'])
 @login_required
 def get_recent_messages():
-    """Get the last 10 messages for a given session."""
+    """Get the last 10 messages for a given session, or the 10 before before_id."""
     data = request.json
     session_id = data.get('session_id')
+    before_id = data.get('before_id')
     user_id = session.get('user_id')
     
     if not session_id:
@@ -1246,16 +1739,13 @@ def get_recent_messages():
     # Verify this session belongs to the current user
     if database.verify_session_ownership(session_id, user_id):
         # Get recent messages (limited to last 10)
-        messages = database.get_session_messages(session_id)
-        
-        # If there are more than 10 messages, get only the last 10
-        if len(messages) > 10:
-            messages = messages[-10:]
+        messages = database.get_recent_messages(session_id, 10, before_id)
         
         # Format messages for frontend
         formatted_messages = []
-        for _, role, content in messages:
+        for message_id, _, role, content in messages:
             formatted_messages.append({
+                "id": message_id,
                 "role": role,
                 "content": content
             })
@@ -1284,12 +1774,8 @@ def clear_chat_history():
     # Verify this session belongs to the current user
     if database.verify_session_ownership(session_id, user_id):
         try:
-            # Delete all messages for this session
-            conn = sqlite3.connect('ocr_cs_tutor.db')
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM conversation_history WHERE session_id = ?", (session_id,))
-            conn.commit()
-            conn.close()
+            # Delete all messages for this session, and the summary of them
+            database.clear_conversation(session_id)
             
             return jsonify({
                 'success': True,
@@ -1306,10 +1792,11 @@ def serve_resource(filename):
     return send_from_directory('resources', filename)
 
 # Function to generate streaming response for global chat
-def generate_global_chat_stream(question, conversation_history):
-    """Generate streaming response for global chat."""
-    # Create a system prompt specifically for general CS questions
-    general_system_prompt = """
+def build_global_chat_request(conversation_history, general_system_prompt=None):
+    """Build the Messages API arguments for a global chat turn."""
+    if general_system_prompt is None:
+        # Create a system prompt specifically for general CS questions
+        general_system_prompt = """
     You are an expert OCR A-Level Computer Science tutor. Answer any computer science questions concisely and accurately.
     Focus on OCR A-Level curriculum topics, but be prepared to answer general computer science questions too.
     Keep responses brief (200-300 words) and use bullet points where appropriate.
@@ -1317,59 +1804,83 @@ def generate_global_chat_stream(question, conversation_history):
     End with 1-2 key takeaways.
     """
     
+    return {
+        'model': AI_MODEL,
+        'max_tokens': 1024,
+        'temperature': 0.7,
+        'system': [cacheable_text(general_system_prompt)],
+        'messages': with_cached_history(conversation_history)
+    }
+
+def generate_global_chat_stream(question, conversation_history, user_id=None, session_id=None, general_system_prompt=None):
+    """Generate streaming response for global chat."""
     client = get_anthropic_client()
     
-    # Create a message and get the streaming response
-    response_stream = client.messages.create(
-        model=AI_MODEL,
-        max_tokens=1024,
-        temperature=0.7,
-        system=general_system_prompt,
-        messages=conversation_history,
-        stream=True
-    )
-    
-    # Track full response for conversation history
-    full_response = ""
-    
-    # Stream each chunk as it comes
-    for chunk in response_stream:
-        if chunk.type == "content_block_delta":
-            text = chunk.delta.text
-            if text:  # Only send non-empty text
-                full_response += text
-                yield f"data: {json.dumps({'text': text})}\n\n"
-    
-    # Send the final response with the complete content
-    yield f"data: {json.dumps({'done': True, 'full_response': full_response})}\n\n"
+    # Wait for an API call slot, telling the student their place in the queue
+    ticket = llm_limiter.enqueue(user_id)
+    try:
+        if not (yield from queue_events(ticket)):
+            return
+        
+        # Create a message and get the streaming response
+        try:
+            response_stream = create_message(client, stream=True, **build_global_chat_request(conversation_history, general_system_prompt))
+        except anthropic.RateLimitError:
+            yield f"data: {json.dumps({'done': True, 'full_response': RATE_LIMIT_MESSAGE})}\n\n"
+            return
+        except anthropic.APIError as e:
+            # Out of retries for an overloaded or unreachable API
+            print(f"Error opening stream: {str(e)}")
+            yield f"data: {json.dumps({'done': True, 'full_response': ERROR_MESSAGE})}\n\n"
+            return
+        
+        # Track full response for conversation history
+        full_response = ""
+        usage = None
+        
+        try:
+            # Stream each chunk as it comes
+            for chunk in response_stream:
+                usage = update_stream_usage(usage, chunk)
+                if chunk.type == "content_block_delta":
+                    text = chunk.delta.text
+                    if text:  # Only send non-empty text
+                        full_response += text
+                        yield f"data: {json.dumps({'text': text})}\n\n"
+            
+            record_usage("global_chat", usage)
+        finally:
+            save_streamed_response(session_id, full_response)
+        
+        # Send the final response with the complete content
+        yield f"data: {json.dumps({'done': True, 'full_response': full_response})}\n\n"
+    finally:
+        llm_limiter.release(ticket)
 
 
 @app.route('/global-chat', methods=['POST', 'GET'])
 @login_required
 def global_chat():
     """API endpoint for general CS questions (not tied to a specific topic) for the logged-in user."""
-    # Global dict to store pending requests
-    if not hasattr(app, 'pending_global_chat_requests'):
-        app.pending_global_chat_requests = {}
-    
     # Handle GET request for EventSource
     if request.method == 'GET':
         request_id = request.args.get('request_id')
         
         if request_id:
             user_id = session.get('user_id')
-            request_key = f"{user_id}:{request_id}"
             
-            # Check if this is a valid pending request
-            if request_key in app.pending_global_chat_requests:
-                request_data = app.pending_global_chat_requests[request_key]
+            # Check if this is a valid pending request (taking it removes it)
+            request_data = get_db().take_pending_request(GLOBAL_STREAM_KINDS, f"{user_id}:{request_id}")
+            if request_data:
                 
                 # Return SSE stream with the pending question data
                 return Response(
-                    generate_global_chat_stream(
+                    stream_with_context(generate_global_chat_stream(
                         request_data['question'], 
-                        request_data['conversation_history']
-                    ),
+                        request_data['conversation_history'],
+                        user_id,
+                        request_data.get('session_id')
+                    )),
                     mimetype='text/event-stream'
                 )
         
@@ -1389,15 +1900,15 @@ def global_chat():
         if not question:
             return jsonify({'error': 'No question provided'}), 400
         
-        # Create a session-specific key for global chat
-        global_chat_key = f'global_chat_history_{user_id}'
-            
-        # Create a session key for global chat if it doesn't exist
-        if global_chat_key not in session:
-            session[global_chat_key] = []
-            
-        # Get conversation history from session
-        conversation_history = session.get(global_chat_key, [])
+        # The conversation is kept in the database, so the session cookie stays small.
+        # Drop the history older versions of the app kept in the cookie
+        session.pop(f'global_chat_history_{user_id}', None)
+        database = get_db()
+        session_id = database.get_global_chat_session(user_id)
+        
+        # Only the most recent messages are sent, plus an outline of older questions
+        summary, conversation_history = database.get_history_window(session_id, max_messages=GLOBAL_CHAT_HISTORY_MESSAGES)
+        conversation_history = with_summary(conversation_history, summary)
         
         # Check if ANTHROPIC_API_KEY is set
         api_key = os.getenv("ANTHROPIC_API_KEY")
@@ -1431,73 +1942,40 @@ Keep your tone supportive and succinct. When a student asks for deeper insights,
         # Add the current question
         messages.append({"role": "user", "content": question})
         
-        # Update conversation history with user message
-        conversation_history.append({"role": "user", "content": question})
-        session[global_chat_key] = conversation_history
+        # Add user message to database
+        database.add_message(session_id, "user", question)
         
         # If streaming is requested, use Server-Sent Events
         if stream_mode and request_id:
             # Store the request data for the streaming endpoint to pick up
-            request_key = f"{user_id}:{request_id}"
-            app.pending_global_chat_requests[request_key] = {
+            database.store_pending_request('global_chat', f"{user_id}:{request_id}", {
                 'question': question,
                 'conversation_history': messages,
-                'timestamp': time.time()
-            }
+                'session_id': session_id
+            })
             
             # Return successful acknowledgement - client will connect to SSE endpoint
             return jsonify({'success': True, 'streaming': True})
         elif stream_mode:
-            # Function to generate SSE data directly
-            def generate():
-                # Create a message and get the streaming response
-                response_stream = client.messages.create(
-                    model=AI_MODEL,
-                    max_tokens=1024,
-                    temperature=0.7,
-                    system=general_system_prompt,
-                    messages=messages,
-                    stream=True
-                )
-                
-                # Track full response for conversation history
-                full_response = ""
-                
-                # Stream each chunk as it comes
-                for chunk in response_stream:
-                    if chunk.type == "content_block_delta":
-                        text = chunk.delta.text
-                        if text:  # Only send non-empty text
-                            full_response += text
-                            yield f"data: {json.dumps({'text': text})}\n\n"
-                
-                # Send the final response with the complete content
-                yield f"data: {json.dumps({'done': True, 'full_response': full_response})}\n\n"
-            
-            return Response(generate(), mimetype='text/event-stream')
+            return Response(
+                stream_with_context(generate_global_chat_stream(question, messages, user_id, session_id, general_system_prompt)),
+                mimetype='text/event-stream'
+            )
         else:
             # Non-streaming response (original functionality)
             # Create a message and get the response
-            response = client.messages.create(
-                model=AI_MODEL,
-                max_tokens=1024,
-                temperature=0.7,
-                system=general_system_prompt,
-                messages=messages
-            )
+            try:
+                with llm_slot(user_id):
+                    response = create_message(client, **build_global_chat_request(messages, general_system_prompt))
+            except (anthropic.RateLimitError, LLMQueueTimeout):
+                return jsonify({'response': RATE_LIMIT_MESSAGE})
+            record_usage("global_chat", usage_counts(response.usage))
             
             # Get the response text
             response_text = response.content[0].text
             
-            # Update conversation history with the response
-            conversation_history.append({"role": "assistant", "content": response_text})
-            
-            # Keep only the last 10 messages
-            if len(conversation_history) > 10:
-                conversation_history = conversation_history[-10:]
-                
-            # Update session
-            session[global_chat_key] = conversation_history
+            # Add assistant message to database
+            database.add_message(session_id, "assistant", response_text)
             
             return jsonify({'response': response_text})
             
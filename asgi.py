@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+OCR A-Level Computer Science AI Tutor ASGI Server
+
+Serves the streaming (EventSource) side of /student/chat and /global-chat with the
+asynchronous Anthropic client, so one process can hold hundreds of open streams
+without tying up a worker thread each. Every other request is passed to the
+Flask application.
+
+Run with:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+
+import os
+import json
+import time
+import asyncio
+import anthropic
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+import app as flask_app
+from Claude_CS_Test import release_connections
+
+# Streaming endpoints served here and the kinds of pending request each one runs
+STREAM_ENDPOINTS = {
+    '/student/chat': ('student_chat', flask_app.STUDENT_STREAM_KINDS),
+    '/global-chat': ('global_chat', flask_app.GLOBAL_STREAM_KINDS)
+}
+
+# Number of Flask requests (logins, uploads, the POST half of each stream, blocking
+# chats) that can run at once in this process
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "32"))
+
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    """Runs one Flask request in the WSGI thread pool.
+    
+    asgiref runs every request on its single shared thread, so one slow request
+    would hold up all the others.
+    """
+    
+    async def run_wsgi_app(self, body):
+        run = sync_to_async(WsgiToAsgiInstance.run_wsgi_app.__wrapped__, thread_sensitive=False, executor=wsgi_executor)
+        await run(self, body)
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi with the WSGI app run in a thread pool."""
+    
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+# Everything else is handled by Flask, in a thread pool
+wsgi_application = ThreadPoolWsgiToAsgi(flask_app.app)
+
+# One asynchronous client shared by all streams in the process
+async_client = None
+
+def get_async_client():
+    """Get the shared asynchronous Anthropic client."""
+    global async_client
+    if async_client is None:
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        if not api_key:
+            print("WARNING: ANTHROPIC_API_KEY environment variable is not set or empty")
+            return None
+        async_client = anthropic.AsyncAnthropic(api_key=api_key, **flask_app.anthropic_client_options())
+    return async_client
+
+async def create_message(client, **kwargs):
+    """Call the Messages API, retrying rate-limited and failed requests like the Flask app does."""
+    for attempt in range(flask_app.ANTHROPIC_MAX_RETRIES + 1):
+        try:
+            return await client.messages.create(**kwargs)
+        except anthropic.APIError as e:
+            if attempt == flask_app.ANTHROPIC_MAX_RETRIES or not flask_app.is_retryable_error(e):
+                raise
+            delay = flask_app.retry_delay(e, attempt)
+            print(f"API request failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+class ClientDisconnected(Exception):
+    """The student closed the page before their request got an API call slot."""
+
+async def wait_for_llm_slot(send, ticket, disconnected):
+    """Wait for a ticket to be granted, sending its queue position whenever it changes.
+    
+    Polls rather than blocking, so no worker thread is held while requests queue.
+    """
+    last_position = None
+    while not ticket.granted.is_set():
+        if disconnected.is_set():
+            raise ClientDisconnected()
+        if time.monotonic() >= ticket.deadline:
+            raise flask_app.LLMQueueTimeout()
+        position = flask_app.llm_limiter.position(ticket)
+        if position and position != last_position:
+            last_position = position
+            await send_event(send, {'queued': True, 'position': position})
+        await asyncio.sleep(flask_app.LLM_QUEUE_POLL_INTERVAL)
+
+def get_user_id(scope):
+    """Read the user ID from the Flask session cookie sent with the request."""
+    app = flask_app.app
+    cookie_name = app.config["SESSION_COOKIE_NAME"]
+    
+    cookies = SimpleCookie()
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            cookies.load(value.decode("latin-1"))
+    if cookie_name not in cookies:
+        return None
+    
+    # Verify and decode the cookie the same way Flask does
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        data = serializer.loads(
+            cookies[cookie_name].value,
+            max_age=int(app.permanent_session_lifetime.total_seconds())
+        )
+    except Exception:
+        return None
+    return data.get('user_id')
+
+def run_with_connections(func, *args):
+    """Run a blocking database function in a worker thread, then return its connections to the pool."""
+    try:
+        return func(*args)
+    finally:
+        release_connections()
+
+def take_pending_request(kinds, request_key):
+    """Take the data stored by the POST half of a streaming request, from whichever worker handled it."""
+    return flask_app.get_db().take_pending_request(kinds, request_key)
+
+def cache_initial_response(cache_key, response):
+    """Add a complete answer to an opening prompt to the cache."""
+    flask_app.get_db().cache_initial_response(cache_key, response)
+
+def cache_answer(request_data, response):
+    """Add a complete answer to a student question to the answer cache."""
+    flask_app.get_db().cache_answer(
+        request_data['topic_code'], request_data.get('mode', 'explore'), request_data['question'], response
+    )
+
+def build_request(endpoint, request_data):
+    """Build the Messages API arguments for a pending request."""
+    if endpoint == 'student_chat':
+        return flask_app.build_chat_request(
+            request_data['question'],
+            request_data['conversation_history'],
+            request_data['topic_code'],
+            request_data.get('mode', 'explore'),
+            request_data.get('summary')
+        )
+    return flask_app.build_global_chat_request(request_data['conversation_history'])
+
+async def send_event(send, data):
+    """Send one Server-Sent Event."""
+    await send({
+        "type": "http.response.body",
+        "body": f"data: {json.dumps(data)}\n\n".encode("utf-8"),
+        "more_body": True
+    })
+
+async def stream_response(scope, receive, send, endpoint, kinds):
+    """Stream a chat response as Server-Sent Events."""
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache")
+        ]
+    })
+    
+    query = parse_qs(scope["query_string"].decode("latin-1"))
+    request_id = query.get("request_id", [None])[0]
+    user_id = get_user_id(scope)
+    client = get_async_client()
+    
+    # Only take the request if it can be answered, so it isn't used up without a reply
+    request_data = None
+    if request_id and client is not None:
+        request_data = await asyncio.to_thread(
+            run_with_connections, take_pending_request, kinds, f"{user_id}:{request_id}"
+        )
+    
+    # For simple connection test or invalid IDs
+    if request_data is None or client is None:
+        await send_event(send, {'connected': True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        return
+    
+    # Replay a cached answer to an opening prompt (already saved to the session)
+    if request_data.get('cached_response'):
+        for text in flask_app.cached_response_chunks(request_data['cached_response']):
+            await send_event(send, {'text': text})
+        await send_event(send, {'done': True, 'full_response': request_data['cached_response']})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        return
+    
+    # Stop generating if the student closes the page
+    disconnected = asyncio.Event()
+    
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
+    
+    watcher = asyncio.create_task(watch_disconnect())
+    
+    # The stored session (a topic session, or the student's general chat) the reply is saved to
+    session_id = request_data.get('session_id')
+    cache_key = request_data.get('cache_key')
+    answer_cache = request_data.get('answer_cache', False)
+    full_response = ""
+    usage = None
+    ticket = flask_app.llm_limiter.enqueue(user_id)
+    try:
+        await wait_for_llm_slot(send, ticket, disconnected)
+        
+        # Knowledge retrieval uses SQLite, so it runs in a worker thread
+        request_args = await asyncio.to_thread(run_with_connections, build_request, endpoint, request_data)
+        
+        response_stream = await create_message(client, stream=True, **request_args)
+        try:
+            # Stream each chunk as it comes
+            async for chunk in response_stream:
+                if disconnected.is_set():
+                    break
+                usage = flask_app.update_stream_usage(usage, chunk)
+                if chunk.type == "content_block_delta":
+                    text = chunk.delta.text
+                    if text:  # Only send non-empty text
+                        full_response += text
+                        await send_event(send, {'text': text})
+        finally:
+            await response_stream.close()
+            
+            # Save the reply, or as much as was generated, before the student sees it finish
+            await asyncio.to_thread(
+                run_with_connections, flask_app.save_streamed_response, session_id, full_response
+            )
+        
+        await asyncio.to_thread(run_with_connections, flask_app.record_usage, endpoint, usage)
+        
+        if cache_key and full_response and not disconnected.is_set():
+            await asyncio.to_thread(
+                run_with_connections, cache_initial_response, cache_key, full_response
+            )
+        if answer_cache and full_response and not disconnected.is_set():
+            await asyncio.to_thread(
+                run_with_connections, cache_answer, request_data, full_response
+            )
+        
+        # Send the final response with the complete content
+        if not disconnected.is_set():
+            await send_event(send, {'done': True, 'full_response': full_response})
+        
+        # Compaction queues for a slot of its own. General chat only sends its
+        # latest few messages, so it isn't compacted
+        flask_app.llm_limiter.release(ticket)
+        if session_id and endpoint == 'student_chat':
+            await asyncio.to_thread(
+                run_with_connections, flask_app.compact_session_history, flask_app.get_db(), session_id, user_id
+            )
+    except ClientDisconnected:
+        pass
+    except (anthropic.RateLimitError, flask_app.LLMQueueTimeout):
+        # Out of rate limit retries, or queued too long for a slot
+        await send_event(send, {'done': True, 'full_response': flask_app.RATE_LIMIT_MESSAGE})
+    except anthropic.APIError as e:
+        # Out of retries for an overloaded or unreachable API, as in the Flask streams
+        print(f"Error in {endpoint} stream: {str(e)}")
+        if not disconnected.is_set():
+            await send_event(send, {'done': True, 'full_response': flask_app.ERROR_MESSAGE})
+    except Exception as e:
+        # Ending the stream early makes the page show its error message
+        print(f"Error in {endpoint} stream: {str(e)}")
+    finally:
+        flask_app.llm_limiter.release(ticket)
+        watcher.cancel()
+    
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+async def application(scope, receive, send):
+    """ASGI entry point."""
+    if scope["type"] == "lifespan":
+        # Nothing to set up: Flask initialises its databases on import
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    
+    if scope["type"] == "http" and scope["method"] == "GET" and scope["path"] in STREAM_ENDPOINTS:
+        endpoint, kinds = STREAM_ENDPOINTS[scope["path"]]
+        await stream_response(scope, receive, send, endpoint, kinds)
+        return
+    
+    await wsgi_application(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    port = int(os.environ.get("PORT", 5000))
+    uvicorn.run(application, host='0.0.0.0', port=port)
@@ -169,6 +169,12 @@ function getAIResponseToExistingMessage(userMessage) {
                     return;
                 }
                 
+                if (data.queued) {
+                    // Waiting for the tutor to be free - show the place in the queue
+                    messageDiv.innerHTML = `<em>Lots of students are asking questions right now. You're number ${data.position} in the queue...</em>`;
+                    return;
+                }
+                
                 if (data.done) {
                     source.close();
                     
@@ -506,6 +512,12 @@ function sendInitialPrompt() {
                     return;
                 }
                 
+                if (data.queued) {
+                    // Waiting for the tutor to be free - show the place in the queue
+                    messageDiv.innerHTML = `<em>Lots of students are asking questions right now. You're number ${data.position} in the queue...</em>`;
+                    return;
+                }
+                
                 if (data.done) {
                     source.close();
                     
@@ -521,22 +533,6 @@ function sendInitialPrompt() {
                         content: fullResponse
                     });
                     
-                    // If we have a session ID in the database, save the response there too
-                    if (sessionDBId) {
-                        fetch('/student/save-response', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json'
-                            },
-                            body: JSON.stringify({
-                                session_id: sessionDBId,
-                                response: fullResponse
-                            })
-                        }).catch(error => {
-                            console.error('Error saving response to database:', error);
-                        });
-                    }
-                    
                     return;
                 }
                 
@@ -649,6 +645,12 @@ function sendMessage() {
                     return;
                 }
                 
+                if (data.queued) {
+                    // Waiting for the tutor to be free - show the place in the queue
+                    messageDiv.innerHTML = `<em>Lots of students are asking questions right now. You're number ${data.position} in the queue...</em>`;
+                    return;
+                }
+                
                 if (data.done) {
                     source.close();
                     
@@ -664,22 +666,6 @@ function sendMessage() {
                         content: fullResponse
                     });
                     
-                    // If we have a session ID in the database, save the response there too
-                    if (sessionDBId) {
-                        fetch('/student/save-response', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json'
-                            },
-                            body: JSON.stringify({
-                                session_id: sessionDBId,
-                                response: fullResponse
-                            })
-                        }).catch(error => {
-                            console.error('Error saving response to database:', error);
-                        });
-                    }
-                    
                     return;
                 }
                 
@@ -176,6 +176,12 @@ function sendGlobalChatMessage() {
                     return;
                 }
                 
+                if (data.queued) {
+                    // Waiting for the tutor to be free - show the place in the queue
+                    messageDiv.innerHTML = `<em>Lots of students are asking questions right now. You're number ${data.position} in the queue...</em>`;
+                    return;
+                }
+                
                 if (data.done) {
                     source.close();
                     